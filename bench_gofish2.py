@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+
+import argparse, gofish2, io, json, os, platform, random, tempfile, time, tracemalloc
+
+# Benchmarks for gofish2's parsing, saving, board replay and memory use, on synthetic games made by
+# a seeded generator so that runs are comparable. Results are written as JSON; each timing is the
+# best of --repeats runs.
+
+# -------------------------------------------------------------------------------------------------
+
+def legal_line(size, moves, rng, board = None):
+
+	# A list of (colour, x, y) legal moves from board (default empty), passing only when the
+	# random search finds nothing.
+
+	board = board.copy() if board else gofish2.Board(size, size)
+	ret = []
+
+	for n in range(moves):
+		colour = board.active
+		for attempt in range(30):
+			x, y = rng.randrange(size), rng.randrange(size)
+			if board.legal_move_colour(gofish2.xy_to_s(x, y), colour):
+				break
+		else:
+			x, y = -1, -1
+		board.play_xy(x, y, colour)
+		ret.append((colour, x, y))
+
+	return ret
+
+
+def synthetic_game(size, moves, seed):
+
+	rng = random.Random("game:{}:{}:{}".format(size, moves, seed))
+
+	with gofish2.TreeBuilder() as builder:
+		builder.set("SZ", size)
+		builder.set("KM", 6.5)
+		for colour, x, y in legal_line(size, moves, rng):
+			builder.new_node()
+			builder.set(colour.upper(), gofish2.xy_to_s(x, y) if x >= 0 else "")
+
+	return builder.root
+
+
+def variation_tree(size, moves, branch_every, branch_length, seed):
+
+	# A main line, with a variation of branch_length moves starting from every branch_every-th
+	# node of it, and from every branch_every-th node of those variations, one level down.
+
+	rng = random.Random("tree:{}:{}:{}:{}:{}".format(size, moves, branch_every, branch_length, seed))
+	root = synthetic_game(size, moves, seed)
+
+	def add_line(start, length):
+		board = start.make_board()
+		ret = []
+		with gofish2.TreeBuilder(start) as builder:
+			for colour, x, y in legal_line(size, length, rng, board):
+				ret.append(builder.new_node())
+				builder.set(colour.upper(), gofish2.xy_to_s(x, y) if x >= 0 else "")
+		return ret
+
+	main_line = list(root.main_line())
+
+	for node in main_line[branch_every::branch_every]:
+		variation = add_line(node, branch_length)
+		for sub in variation[branch_every::branch_every]:
+			add_line(sub, branch_length // 2)
+
+	return root
+
+
+def wide_tree(size, width, length, seed):			# width lines of length moves, all from the root
+
+	rng = random.Random("wide:{}:{}:{}:{}".format(size, width, length, seed))
+	root = gofish2.Node()
+	root.set("SZ", size)
+	board = gofish2.Board(size, size)
+
+	with gofish2.TreeBuilder(root) as builder:
+		for n in range(width):
+			builder.goto(root)
+			for colour, x, y in legal_line(size, length, rng, board):
+				builder.new_node()
+				builder.set(colour.upper(), gofish2.xy_to_s(x, y) if x >= 0 else "")
+
+	return root
+
+
+def sgf_bytes(root):
+	f = io.StringIO()
+	gofish2._write_tree(f, root)
+	return f.getvalue().encode("utf-8")
+
+
+def ngf_bytes(root):
+
+	lines = ["Synthetic", str(root.width), "White 1d", "Black 1d", "", "0", "", "6", "20220101", "", "Black wins by resign", ""]
+
+	for n, node in enumerate(root.main_line()):
+		for key in ["B", "W"]:
+			if key in node.props:
+				xy = gofish2.s_to_xy(node.props[key][0]) if node.props[key][0] else (-1, -1)
+				lines.append("PM{:02d}{}{}{}{}{}".format(n % 100, key, chr(xy[0] + 66), chr(xy[1] + 66), chr(xy[0] + 66), chr(xy[1] + 66)))
+
+	return "\n".join(lines).encode("utf-8")
+
+
+def gib_bytes(root):						# 19x19 only
+
+	lines = ["\\[GAMETAG=S1,R3,D0,G65,W3,Z0,T30-3-600,C2022:01:01:12:00,A:White 1d,B:Black 1d,J:1d,K:1d\\]", "INI 0 1 0 &4"]
+
+	for n, node in enumerate(root.main_line()):
+		for key in ["B", "W"]:
+			if key in node.props and node.props[key][0]:
+				x, y = gofish2.s_to_xy(node.props[key][0])
+				lines.append("STO 0 {} {} {} {}".format(n, 2 if key == "W" else 1, x, y))
+
+	return "\n".join(lines).encode("utf-8")
+
+# -------------------------------------------------------------------------------------------------
+
+def best_time(fn, repeats):
+
+	best = None
+	for n in range(repeats):
+		t = time.perf_counter()
+		fn()
+		elapsed = time.perf_counter() - t
+		if best is None or elapsed < best:
+			best = elapsed
+	return best
+
+
+def bench_load(name, loader, bufs, repeats):
+
+	total = sum(len(buf) for buf in bufs)
+
+	def run():
+		for buf in bufs:
+			loader(buf)
+
+	seconds = best_time(run, repeats)
+	return {"format": name, "files": len(bufs), "bytes": total, "seconds": seconds,
+		"bytes_per_second": total / seconds if seconds > 0 else 0, "files_per_second": len(bufs) / seconds if seconds > 0 else 0}
+
+
+def bench_save(roots, repeats):
+
+	with tempfile.TemporaryDirectory() as tmp:
+
+		filename = os.path.join(tmp, "bench.sgf")
+		total = 0
+
+		def run():
+			nonlocal total
+			total = 0
+			for root in roots:
+				gofish2.save(filename, root)
+				total += os.path.getsize(filename)
+
+		seconds = best_time(run, repeats)
+
+	nodes = sum(root.tree_size() for root in roots)
+	return {"files": len(roots), "nodes": nodes, "bytes": total, "seconds": seconds,
+		"bytes_per_second": total / seconds if seconds > 0 else 0, "nodes_per_second": nodes / seconds if seconds > 0 else 0}
+
+
+def bench_make_board(buf, repeats):
+
+	# Boards for every node of a freshly loaded tree (so each cache is cold at first), then just
+	# the last node of the main line, which has to replay the whole line.
+
+	def every_node():
+		root = gofish2.load_sgf(buf)[0]
+		for node in root.preorder():
+			node.make_board()
+
+	def deep_end():
+		root = gofish2.load_sgf(buf)[0]
+		root.get_end().make_board()
+
+	def load_only():
+		gofish2.load_sgf(buf)
+
+	root = gofish2.load_sgf(buf)[0]
+	nodes = root.tree_size()
+	depth = len(root.get_end().history())
+	base = best_time(load_only, repeats)
+
+	every = best_time(every_node, repeats) - base
+	end = best_time(deep_end, repeats) - base
+
+	return {"nodes": nodes, "main_line_nodes": depth,
+		"all_nodes_seconds": every, "per_node": every / nodes if nodes else 0,
+		"end_of_main_line_seconds": end, "end_per_replayed_node": end / depth if depth else 0}
+
+
+def bench_legal_move(root, repeats):
+
+	# Every point tested for legality, at every 10th position of the main line.
+
+	boards = [node.make_board() for node in list(root.main_line())[::10]]
+	points = [gofish2.xy_to_s(x, y) for x in range(root.width) for y in range(root.height)]
+
+	def run():
+		for board in boards:
+			for s in points:
+				board.legal_move(s)
+
+	calls = len(boards) * len(points)
+	seconds = best_time(run, repeats)
+	return {"calls": calls, "seconds": seconds, "per_call": seconds / calls if calls else 0}
+
+
+def bench_tree_size(root, repeats):
+
+	nodes = root.tree_size()
+	seconds = best_time(root.tree_size, repeats)
+	return {"nodes": nodes, "root_children": len(root.children), "seconds": seconds,
+		"nodes_per_second": nodes / seconds if seconds > 0 else 0}
+
+
+def bench_memory(buf):
+
+	tracemalloc.start()
+	before = tracemalloc.get_traced_memory()[0]
+	root = gofish2.load_sgf(buf)[0]
+	after = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+
+	nodes = root.tree_size()
+	return {"nodes": nodes, "bytes": after - before, "bytes_per_node": (after - before) / nodes if nodes else 0}
+
+# -------------------------------------------------------------------------------------------------
+
+def main():
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--output", help = "write JSON here instead of stdout")
+	parser.add_argument("--sizes", default = "9,13,19", help = "comma-separated board sizes")
+	parser.add_argument("--moves", default = "50,200", help = "comma-separated main line lengths")
+	parser.add_argument("--games", type = int, default = 20, help = "games per size and length for the parser benchmarks")
+	parser.add_argument("--branch-every", type = int, default = 10)
+	parser.add_argument("--branch-length", type = int, default = 20)
+	parser.add_argument("--wide", type = int, default = 2000, help = "root children in the wide tree")
+	parser.add_argument("--repeats", type = int, default = 3)
+	parser.add_argument("--seed", type = int, default = 1)
+	opts = parser.parse_args()
+
+	sizes = [int(z) for z in opts.sizes.split(",")]
+	lengths = [int(z) for z in opts.moves.split(",")]
+	results = []
+
+	for size in sizes:
+		for moves in lengths:
+
+			games = [synthetic_game(size, moves, opts.seed + n) for n in range(opts.games)]
+			tree = variation_tree(size, moves, opts.branch_every, opts.branch_length, opts.seed)
+			tree_buf = sgf_bytes(tree)
+
+			item = {"size": size, "moves": moves, "tree_nodes": tree.tree_size()}
+			item["load_sgf"] = bench_load("sgf", gofish2.load_sgf, [sgf_bytes(root) for root in games], opts.repeats)
+			item["load_sgf_tree"] = bench_load("sgf", gofish2.load_sgf, [tree_buf], opts.repeats)
+			item["load_ngf"] = bench_load("ngf", gofish2.load_ngf, [ngf_bytes(root) for root in games], opts.repeats)
+			if size == 19:
+				item["load_gib"] = bench_load("gib", gofish2.load_gib, [gib_bytes(root) for root in games], opts.repeats)
+			item["save"] = bench_save(games + [tree], opts.repeats)
+			item["make_board"] = bench_make_board(tree_buf, opts.repeats)
+			item["legal_move"] = bench_legal_move(games[0], opts.repeats)
+			item["memory"] = bench_memory(tree_buf)
+
+			results.append(item)
+
+	wide = wide_tree(19, opts.wide, 3, opts.seed)
+
+	report = {
+		"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"params": {"sizes": sizes, "moves": lengths, "games": opts.games, "branch_every": opts.branch_every,
+			"branch_length": opts.branch_length, "wide": opts.wide, "repeats": opts.repeats, "seed": opts.seed},
+		"results": results,
+		"tree_size_wide": bench_tree_size(wide, opts.repeats),
+		"memory_wide": bench_memory(sgf_bytes(wide)),
+	}
+
+	s = json.dumps(report, indent = 1)
+
+	if opts.output:
+		with open(opts.output, "w", encoding = "utf8") as outfile:
+			outfile.write(s + "\n")
+	else:
+		print(s)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+import argparse, bench_gofish2, json, ka, os, platform, shlex, sys, time
+
+# Benchmarks for the GTP side of ka.py, run against stub_engine.py so that no KataGo binary is
+# needed and results are repeatable. Pass --engine-command to measure a real engine instead.
+# Results are written as JSON, for comparing runs.
+
+stub_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stub_engine.py")
+
+# -------------------------------------------------------------------------------------------------
+
+def percentiles(samples):
+
+	samples = sorted(samples)
+	n = len(samples)
+
+	if n == 0:
+		return {"count": 0}
+
+	def pick(p):
+		return samples[min(n - 1, int(p * n))]
+
+	return {
+		"count": n,
+		"mean": sum(samples) / n,
+		"p50": pick(0.50),
+		"p90": pick(0.90),
+		"p99": pick(0.99),
+		"max": samples[-1],
+	}
+
+
+def synthetic_game(size, moves, branch_every, seed):
+
+	# bench_gofish2's seeded games, plus (if branch_every) a one-move variation every so often.
+
+	if branch_every:
+		return bench_gofish2.variation_tree(size, moves, branch_every, 1, seed)
+	return bench_gofish2.synthetic_game(size, moves, seed)
+
+# -------------------------------------------------------------------------------------------------
+
+def bench_roundtrip(katago, count):
+
+	# Strictly sequential: each command waits for its reply before the next is sent.
+
+	ret = {}
+
+	for cmd in ["name", "play", "showboard"]:
+		samples = []
+		for n in range(count):
+			if cmd == "play":
+				katago.command("clear_board")
+				t = time.perf_counter()
+				katago.command("play b D4")
+			else:
+				t = time.perf_counter()
+				katago.command(cmd)
+			samples.append(time.perf_counter() - t)
+		ret[cmd] = percentiles(samples)
+
+	return ret
+
+
+def bench_position_sync(katago, size, moves, repeats, seed):
+
+	# The cost of getting the engine to a position: all the plays are pipelined, and the final
+	# command's reply tells us they are all done.
+
+	root = synthetic_game(size, moves, 0, seed)
+	node_list = root.get_end().history()
+	commands = []
+	for node in node_list:
+		for colour, vertex in ka.gtp_moves(node, size):
+			commands.append(f"play {colour} {vertex}")
+
+	samples = []
+
+	for n in range(repeats):
+		katago.command(f"boardsize {size}")
+		katago.command("clear_board")
+		t = time.perf_counter()
+		for msg in commands:
+			katago.send(msg)
+		katago.command("name")
+		samples.append(time.perf_counter() - t)
+
+	ret = percentiles(samples)
+	ret["moves"] = len(commands)
+	ret["per_move_mean"] = ret["mean"] / len(commands) if commands else 0
+	return ret
+
+
+def bench_analysis(katago, size, moves, branch_every, visits, seed):
+
+	root = synthetic_game(size, moves, branch_every, seed)
+	stopper = ka.AnyOf(ka.VisitLimit(visits))
+
+	katago.command(f"boardsize {size}")
+	katago.command("clear_board")
+
+	t = time.perf_counter()
+	count = ka.walk_tree(katago, stopper, root, size, verbose = False)
+	elapsed = time.perf_counter() - t
+
+	return {
+		"nodes": count,
+		"tree_size": root.tree_size(),
+		"visits_per_node": visits,
+		"seconds": elapsed,
+		"nodes_per_second": count / elapsed if elapsed > 0 else 0,
+	}
+
+# -------------------------------------------------------------------------------------------------
+
+def main():
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--output", help = "write JSON here instead of stdout")
+	parser.add_argument("--engine-command", help = "command line of the engine to benchmark")
+	parser.add_argument("--latency", type = float, default = 0, help = "stub reply latency in seconds")
+	parser.add_argument("--interval", type = float, default = 0.01, help = "stub seconds between info lines")
+	parser.add_argument("--visits-per-line", type = int, default = 100, help = "stub visits added per info line")
+	parser.add_argument("--replay", help = "stub transcript to replay")
+	parser.add_argument("--count", type = int, default = 200, help = "round-trips per command type")
+	parser.add_argument("--size", type = int, default = 19)
+	parser.add_argument("--moves", type = int, default = 100, help = "moves in the synthetic games")
+	parser.add_argument("--branch-every", type = int, default = 10, help = "add a variation every this many moves")
+	parser.add_argument("--visits", type = int, default = 300, help = "visits per analysed node")
+	parser.add_argument("--seed", type = int, default = 1)
+	opts = parser.parse_args()
+
+	if opts.engine_command:
+		command = shlex.split(opts.engine_command)
+		engine = {"command": opts.engine_command}
+	else:
+		command = [sys.executable, stub_path, "--latency", str(opts.latency), "--interval", str(opts.interval),
+			"--visits-per-line", str(opts.visits_per_line)]
+		if opts.replay:
+			command += ["--replay", opts.replay]
+		engine = {"stub": True, "latency": opts.latency, "interval": opts.interval,
+			"visits_per_line": opts.visits_per_line, "replay": opts.replay}
+
+	katago = ka.KataGo(command, stats = True)
+	katago.echo = False
+	katago.command("name")						# Wait for the engine to be ready
+
+	results = {
+		"roundtrip": bench_roundtrip(katago, opts.count),
+		"position_sync": bench_position_sync(katago, opts.size, opts.moves, max(1, opts.count // 20), opts.seed),
+		"analysis": bench_analysis(katago, opts.size, opts.moves, opts.branch_every, opts.visits, opts.seed),
+		"client_stats": katago.stats.snapshot(),
+	}
+
+	report = {
+		"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"engine": engine,
+		"params": {"count": opts.count, "size": opts.size, "moves": opts.moves,
+			"branch_every": opts.branch_every, "visits": opts.visits, "seed": opts.seed},
+		"results": results,
+	}
+
+	s = json.dumps(report, indent = 1)
+
+	if opts.output:
+		with open(opts.output, "w", encoding = "utf8") as outfile:
+			outfile.write(s + "\n")
+	else:
+		print(s)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+import argparse, gofish2, struct, sys
+
+# Builds an opening tree from the main lines of many games. Positions are identified by Zobrist
+# hash, so transpositions land on the same node, and optionally the symmetries of the board are
+# folded together by keying each position on the smallest hash over all its orientations.
+# Games are read one file at a time and thrown away, and if max_nodes is set the rarest
+# positions are pruned whenever the tree grows past it, so memory stays bounded.
+
+# -------------------------------------------------------------------------------------------------
+
+def _hashes(board, syms):
+	if syms == [0]:
+		return [board.zobrist()]
+	hashes = board.symmetry_hashes()
+	return [hashes[sym] for sym in syms]
+
+# -------------------------------------------------------------------------------------------------
+
+class OpeningNode():
+
+	__slots__ = ("key", "count", "black_wins", "white_wins", "edges")
+
+	def __init__(self, key):
+		self.key = key
+		self.count = 0							# Games that reached this position
+		self.black_wins = 0
+		self.white_wins = 0
+		self.edges = dict()						# child key --> [point, count], point being x * 52 + y
+
+	def __repr__(self):
+		return "<OpeningNode {:016x} count {} B {} W {}>".format(self.key, self.count, self.black_wins, self.white_wins)
+
+
+class OpeningTree():
+
+	def __init__(self, size = 19, depth = 30, fold_symmetry = False, max_nodes = None):
+
+		self.size = size
+		self.depth = depth
+		self.fold_symmetry = fold_symmetry
+		self.max_nodes = max_nodes
+		self.nodes = dict()						# key --> OpeningNode
+		self.root_keys = dict()					# key --> count, for positions games started from
+		self.games = 0
+		self.skipped = 0
+		self.prune_count = 0					# Positions seen this many times or fewer have been pruned
+
+		self.syms = list(range(8)) if fold_symmetry else [0]
+
+
+	def _node(self, key):
+		node = self.nodes.get(key)
+		if not node:
+			node = OpeningNode(key)
+			self.nodes[key] = node
+		return node
+
+
+	def add_game(self, root):
+
+		if root.width != self.size or root.height != self.size:
+			self.skipped += 1
+			return
+
+		re = root.get("RE").upper()
+		black_won = re.startswith("B+")
+		white_won = re.startswith("W+")
+
+		board = gofish2.Board(self.size, self.size)
+		root.apply(board)
+		hashes = _hashes(board, self.syms)
+
+		key = min(hashes)
+		sym = hashes.index(key)
+		self.root_keys[key] = self.root_keys.get(key, 0) + 1
+
+		seen = set()							# So a position repeated within one game counts once
+		node = root
+		plies = 0
+
+		while True:
+
+			if key not in seen:
+				seen.add(key)
+				onode = self._node(key)
+				onode.count += 1
+				if black_won:
+					onode.black_wins += 1
+				if white_won:
+					onode.white_wins += 1
+
+			if plies >= self.depth or len(node.children) == 0:
+				break
+
+			node = node.children[0]
+			plies += 1
+
+			caps = board.caps_by_b + board.caps_by_w
+			active = board.active
+			move = node.get("B") or node.get("W")
+			colour = "b" if node.has_key("B") else "w"
+			point = None
+
+			if move and node.validated_move_string(move):
+				point = gofish2.s_to_xy(move)
+
+			node.apply(board)
+
+			# Usually the only change is one new stone and the side to move, so update the
+			# hashes in place; anything else (captures, setup, passes, PL) means starting over.
+
+			simple = point is not None and board.caps_by_b + board.caps_by_w == caps and board.active != active \
+				and len(node.props.get("B", []) + node.props.get("W", [])) == 1 \
+				and not any(k in node.props for k in ["AB", "AW", "AE", "PL"])
+
+			if simple:
+				table = gofish2.zobrist_b if colour == "b" else gofish2.zobrist_w
+				for i, s in enumerate(self.syms):
+					tx, ty = gofish2.transform_xy(point[0], point[1], s, self.size, self.size)
+					hashes[i] ^= table[tx * 52 + ty] ^ gofish2.zobrist_white_to_move
+			else:
+				hashes = _hashes(board, self.syms)
+
+			child_key = min(hashes)
+
+			parent = self._node(key)
+			edge = parent.edges.get(child_key)
+			if edge:
+				edge[1] += 1
+			else:
+				if point is None:
+					label = 0xffff				# Pass, or something other than a move
+				else:
+					tx, ty = gofish2.transform_xy(point[0], point[1], sym, self.size, self.size)
+					label = tx * 52 + ty
+				parent.edges[child_key] = [label, 1]
+
+			key = child_key
+			sym = hashes.index(key)
+
+		self.games += 1
+
+		if self.max_nodes and len(self.nodes) > self.max_nodes:
+			self.prune()
+
+
+	def add_file(self, filename):
+		for root in gofish2.load(filename):
+			self.add_game(root)
+
+
+	def add_files(self, filenames, errors = None):
+
+		for filename in filenames:
+			try:
+				self.add_file(filename)
+			except Exception as err:
+				if errors is not None:
+					errors.append((filename, err))
+
+
+	def prune(self):
+
+		# Drops the rarest positions until the tree is back under three quarters of max_nodes.
+		# Their counts are lost, so after pruning, counts are lower bounds for rare lines. Root
+		# positions are never dropped, so they don't count towards the target (otherwise having
+		# more of them than the target would mean pruning forever).
+
+		roots = sum(1 for k in self.root_keys if k in self.nodes)
+		target = max(self.max_nodes * 3 // 4 - roots, 0)
+
+		while len(self.nodes) - roots > target:
+			self.prune_count += 1
+			self.nodes = {k: v for k, v in self.nodes.items() if v.count > self.prune_count or k in self.root_keys}
+
+		for onode in self.nodes.values():
+			for child_key in [k for k in onode.edges if k not in self.nodes]:
+				del onode.edges[child_key]
+
+
+	def children(self, onode):
+
+		# [(SGF move or "", edge count, OpeningNode)], most played first. With symmetry folding the
+		# move is in the orientation of the parent's canonical form.
+
+		ret = []
+		for child_key, (label, count) in onode.edges.items():
+			child = self.nodes.get(child_key)
+			if not child:
+				continue
+			s = "" if label == 0xffff else gofish2.xy_to_s(label // 52, label % 52)
+			ret.append((s, count, child))
+		ret.sort(key = lambda z: -z[1])
+		return ret
+
+
+	def roots(self):
+		return [self.nodes[k] for k in sorted(self.root_keys, key = lambda k: -self.root_keys[k]) if k in self.nodes]
+
+
+	# Compact binary format: a header, then for each node its key, counts and edges, all packed.
+
+	_header = struct.Struct("<4sHHHBI")			# magic, version, size, depth, fold_symmetry, node count
+	_node_rec = struct.Struct("<QIIIH")			# key, count, black_wins, white_wins, edge count
+	_edge_rec = struct.Struct("<QHI")			# child key, point, count
+	_root_rec = struct.Struct("<QI")			# key, count
+
+	def save(self, filename):
+
+		with open(filename, "wb") as outfile:
+
+			outfile.write(self._header.pack(b"GFOT", 1, self.size, self.depth, int(self.fold_symmetry), len(self.nodes)))
+
+			for onode in self.nodes.values():
+				edges = [(k, e) for k, e in onode.edges.items() if k in self.nodes]
+				outfile.write(self._node_rec.pack(onode.key, onode.count, onode.black_wins, onode.white_wins, len(edges)))
+				for child_key, (label, count) in edges:
+					outfile.write(self._edge_rec.pack(child_key, label, count))
+
+			outfile.write(struct.pack("<I", len(self.root_keys)))
+			for key, count in self.root_keys.items():
+				outfile.write(self._root_rec.pack(key, count))
+
+
+	@classmethod
+	def load(cls, filename):
+
+		with open(filename, "rb") as infile:
+			buf = infile.read()
+
+		magic, version, size, depth, fold, n = cls._header.unpack_from(buf, 0)
+
+		if magic != b"GFOT" or version != 1:
+			raise ValueError("Not an opening tree file")
+
+		tree = cls(size, depth, bool(fold))
+		off = cls._header.size
+
+		for i in range(n):
+			key, count, bw, ww, edge_count = cls._node_rec.unpack_from(buf, off)
+			off += cls._node_rec.size
+			onode = OpeningNode(key)
+			onode.count, onode.black_wins, onode.white_wins = count, bw, ww
+			for j in range(edge_count):
+				child_key, label, ecount = cls._edge_rec.unpack_from(buf, off)
+				off += cls._edge_rec.size
+				onode.edges[child_key] = [label, ecount]
+			tree.nodes[key] = onode
+
+		root_count, = struct.unpack_from("<I", buf, off)
+		off += 4
+		for i in range(root_count):
+			key, count = cls._root_rec.unpack_from(buf, off)
+			off += cls._root_rec.size
+			tree.root_keys[key] = count
+
+		return tree
+
+# -------------------------------------------------------------------------------------------------
+
+def main():
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("output", help = "file to save the tree to")
+	parser.add_argument("filenames", nargs = "+")
+	parser.add_argument("--size", type = int, default = 19)
+	parser.add_argument("--depth", type = int, default = 30, help = "moves of each main line to use")
+	parser.add_argument("--symmetry", action = "store_true", help = "fold the board's symmetries together")
+	parser.add_argument("--max-nodes", type = int, help = "prune rare positions to stay near this many")
+	opts = parser.parse_args()
+
+	tree = OpeningTree(opts.size, opts.depth, opts.symmetry, opts.max_nodes)
+	errors = []
+	tree.add_files(opts.filenames, errors)
+
+	for filename, err in errors:
+		print("{}: {}".format(filename, err), file = sys.stderr)
+
+	tree.save(opts.output)
+
+	print("{} games, {} skipped, {} positions".format(tree.games, tree.skipped, len(tree.nodes)))
+
+	for root in tree.roots()[:1]:
+		for s, count, child in tree.children(root)[:10]:
+			print("{:4} {:8} B {:5.1f}%".format(s or "pass", count, 100 * child.black_wins / child.count if child.count else 0))
+
+
+if __name__ == "__main__":
+	main()
@@ -1,5 +1,10 @@
 #!/usr/bin/env python3
 
+import gc, random, struct, time
+from array import array
+from collections import deque
+from multiprocessing import shared_memory
+
 class ParserFail(Exception):
 	pass
 
@@ -24,6 +29,7 @@ class Board:
 		self.active = active
 		self.caps_by_b = caps_by_b
 		self.caps_by_w = caps_by_w
+		self.neighbour_table = neighbour_table(width, height)
 
 		for x in range(width):
 			self.state.append([])
@@ -52,6 +58,84 @@ class Board:
 		return Board(self.width, self.height, self.state, self.ko, self.active, self.caps_by_b, self.caps_by_w)
 
 
+	def __getstate__(self):
+
+		# The neighbour table is shared by every board of this size, so pickles leave it out and
+		# get it back from the module cache.
+
+		state = self.__dict__.copy()
+		del state["neighbour_table"]
+		return state
+
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.neighbour_table = neighbour_table(self.width, self.height)
+
+
+	def zobrist(self):					# Stones and side to move; not ko, captures, or board size.
+
+		h = zobrist_white_to_move if self.active == "w" else 0
+
+		for x in range(self.width):
+			column = self.state[x]
+			base = x * 52
+			for y in range(self.height):
+				if column[y] == "b":
+					h ^= zobrist_b[base + y]
+				elif column[y] == "w":
+					h ^= zobrist_w[base + y]
+
+		return h
+
+
+	def symmetry_hashes(self):
+
+		# Zobrist hashes of all 8 orientations (see transform_xy), in one pass over the board.
+
+		base = zobrist_white_to_move if self.active == "w" else 0
+		ret = [base] * 8
+
+		for x in range(self.width):
+			column = self.state[x]
+			for y in range(self.height):
+				colour = column[y]
+				if not colour:
+					continue
+				table = zobrist_b if colour == "b" else zobrist_w
+				for sym in range(8):
+					tx, ty = transform_xy(x, y, sym, self.width, self.height)
+					ret[sym] ^= table[tx * 52 + ty]
+
+		return ret
+
+
+	def canonical(self):
+
+		# Returns (hash, sym) where sym is the orientation with the smallest hash; two positions that
+		# are rotations or reflections of each other get the same hash. Board size isn't hashed.
+
+		hashes = self.symmetry_hashes()
+		h = min(hashes)
+		return (h, hashes.index(h))
+
+
+	def transformed(self, sym):
+
+		width, height = symmetry_size(sym, self.width, self.height)
+		ret = Board(width, height, None, None, self.active, self.caps_by_b, self.caps_by_w)
+
+		for x in range(self.width):
+			for y in range(self.height):
+				tx, ty = transform_xy(x, y, sym, self.width, self.height)
+				ret.state[tx][ty] = self.state[x][y]
+
+		if self.ko:
+			ret.ko = transform_s(self.ko, sym, self.width, self.height)
+
+		return ret
+
+
 	def dump(self):
 
 		if self.ko:
@@ -92,22 +176,14 @@ class Board:
 		self.state[x][y] = colour
 
 
-	def neighbours(self, s):
+	def neighbours(self, s):			# The returned list is shared; don't change it
 
-		x, y = s_to_xy(s)
+		ret = self.neighbour_table.get(s)
 
-		if x < 0 or x >= self.width or y < 0 or y >= self.height:
+		if ret is None:
+			s_to_xy(s)				# Raises TypeError for non-strings
 			raise ValueError		# s was out of bounds
 
-		ret = []
-		if x < self.width - 1:
-			ret.append(xy_to_s(x + 1, y))
-		if x > 0:
-			ret.append(xy_to_s(x - 1, y))
-		if y < self.height - 1:
-			ret.append(xy_to_s(x, y + 1))
-		if y > 0:
-			ret.append(xy_to_s(x, y - 1))
 		return ret
 
 
@@ -272,16 +348,213 @@ class Board:
 
 		return None
 
+
+	def play_xy(self, x, y, colour):	# As play_move_or_pass() but with integer coordinates; off-board is a pass
+
+		self.ko = None
+		self.active = "b" if colour == "w" else "w"
+
+		if x < 0 or x >= self.width or y < 0 or y >= self.height:
+			return
+
+		self._place_xy(x, y, colour, self._store_xy)
+
+
+	def _store_xy(self, x, y, colour):
+		self.state[x][y] = colour
+
+
+	def _place_xy(self, x, y, colour, change):
+
+		# The rules, shared by play_xy() and validate_tree(): puts the stone at (on-board) x,y,
+		# removes any groups it captures and then, if it has no liberties, its own group, counts
+		# the captures and sets the ko square, which the caller must have cleared. Every change
+		# to the board goes through change(x, y, colour). Returns the number of stones lost to
+		# suicide.
+
+		state = self.state
+		width = self.width
+		height = self.height
+
+		change(x, y, colour)
+		caps = 0
+
+		for nx, ny in ((x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)):
+			if 0 <= nx < width and 0 <= ny < height:
+				neighbour_colour = state[nx][ny]
+				if neighbour_colour and neighbour_colour != colour:
+					dead = self._dead_group_xy(nx, ny)
+					if dead:
+						for sx, sy in dead:
+							change(sx, sy, "")
+						caps += len(dead)
+
+		if colour == "b":
+			self.caps_by_b += caps
+		else:
+			self.caps_by_w += caps
+
+		dead = self._dead_group_xy(x, y)
+		if dead:
+			for sx, sy in dead:
+				change(sx, sy, "")
+			if colour == "b":
+				self.caps_by_w += len(dead)
+			else:
+				self.caps_by_b += len(dead)
+
+		if caps == 1:
+			empties = []
+			for nx, ny in ((x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)):
+				if 0 <= nx < width and 0 <= ny < height:
+					if state[nx][ny] == colour:
+						empties = []
+						break
+					if not state[nx][ny]:
+						empties.append((nx, ny))
+			if len(empties) == 1:
+				self.ko = xy_to_s(empties[0][0], empties[0][1])
+
+		return len(dead) if dead else 0
+
+
+	def _dead_group_xy(self, x, y):		# The stones of the group at x,y if it has no liberties, else None
+
+		state = self.state
+		width = self.width
+		height = self.height
+		colour = state[x][y]
+
+		stones = [(x, y)]
+		seen = {(x, y)}
+		i = 0
+
+		while i < len(stones):
+			x, y = stones[i]
+			i += 1
+			for nx, ny in ((x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)):
+				if 0 <= nx < width and 0 <= ny < height and (nx, ny) not in seen:
+					neighbour_colour = state[nx][ny]
+					if not neighbour_colour:
+						return None
+					if neighbour_colour == colour:
+						seen.add((nx, ny))
+						stones.append((nx, ny))
+
+		return stones
+
+
+	def replay(self, line, count = None):		# Plays the first count moves of a PackedLine, with its setup
+
+		for board, move in line.positions(self, count):
+			pass
+		return self
+
+
+	def score(self, komi = 0, dead = None, ownership = None):
+
+		# Area score, Black minus White minus komi: stones plus empty regions that touch only one
+		# colour. dead lists stones to remove first, as SGF strings or as points (x * 52 + y, so a
+		# point array from the batch functions below will do); alternatively ownership is a flat
+		# sequence, row by row from the top and positive for Black (e.g. a KataGo ownership array
+		# from Black's perspective), and stones owned more than halfway by the other colour are
+		# removed. Removed stones then count as territory like empty points.
+
+		width = self.width
+		height = self.height
+		grid = [""] * (width * height)		# Indexed y * width + x
+
+		for x in range(width):
+			column = self.state[x]
+			for y in range(height):
+				grid[y * width + x] = column[y]
+
+		if dead is not None:
+			for s in _plain_points(dead):
+				if isinstance(s, str):
+					x, y = _string_xy.get(s, (-1, -1))		# Passes ("") and junk are skipped
+				else:
+					x, y = s // 52, s % 52		# Passes come out off the board
+				if 0 <= x < width and 0 <= y < height:
+					grid[y * width + x] = ""
+
+		if ownership is not None:
+			for i in range(width * height):
+				if (grid[i] == "b" and ownership[i] < -0.5) or (grid[i] == "w" and ownership[i] > 0.5):
+					grid[i] = ""
+
+		black = 0
+		white = 0
+		seen = [False] * (width * height)
+
+		for i in range(width * height):
+
+			if grid[i] == "b":
+				black += 1
+				continue
+			if grid[i] == "w":
+				white += 1
+				continue
+			if seen[i]:
+				continue
+
+			# Flood the empty region from here, noting which colours border it.
+
+			seen[i] = True
+			stack = [i]
+			size = 0
+			touches_b = False
+			touches_w = False
+
+			while stack:
+				j = stack.pop()
+				size += 1
+				x = j % width
+				neighbours = []
+				if x > 0:
+					neighbours.append(j - 1)
+				if x < width - 1:
+					neighbours.append(j + 1)
+				if j >= width:
+					neighbours.append(j - width)
+				if j < width * (height - 1):
+					neighbours.append(j + width)
+				for k in neighbours:
+					colour = grid[k]
+					if colour == "b":
+						touches_b = True
+					elif colour == "w":
+						touches_w = True
+					elif not seen[k]:
+						seen[k] = True
+						stack.append(k)
+
+			if touches_b and not touches_w:
+				black += size
+			elif touches_w and not touches_b:
+				white += size
+
+		return black - white - komi
+
 # -------------------------------------------------------------------------------------------------
 
 class Node:
 
+	# Cached boards are invalidated lazily. Every change to a board-affecting property stamps the
+	# node with a new value of the global _generation, and each cached board remembers the
+	# generation it was made at. A cached board is good if it's newer than every stamp on the
+	# path from the root, so a change is O(1) and stale boards get rebuilt on the next use.
+
+	_generation = 0
+
 	def __init__(self, parent = None):
 
 		self.parent = parent
 		self.children = []
 		self.props = dict()
 		self._board = None
+		self._board_gen = 0					# Generation when _board was made
+		self._gen = 0						# Generation of the last board-affecting change here
 
 		if parent:
 			parent.children.append(self)
@@ -290,7 +563,7 @@ class Node:
 	@property
 	def width(self):
 
-		if self._board:
+		if self._board and self._board_gen == Node._generation:
 			return self._board.width
 
 		root = self.get_root()
@@ -313,7 +586,7 @@ class Node:
 	@property
 	def height(self):
 
-		if self._board:
+		if self._board and self._board_gen == Node._generation:
 			return self._board.height
 
 		root = self.get_root()
@@ -363,29 +636,55 @@ class Node:
 
 		# Also caches the entire history (not doing so is silly, I guess).
 
-		if self._board:
-			return
+		# Returns how many boards it had to make, which only the counters (see below) look at.
 
-		node = self
-		history = []
-		work_board = None
+		if self._board and self._board_gen == Node._generation:
+			return 0							# Nothing has changed anywhere since it was made
 
+		# Walk up to the nearest board already checked at the current generation, which must be
+		# good. Without one, the whole path from the root has to be looked at.
+
+		path = []
+		node = self
 		while node:
-			if node._board:
-				work_board = node._board.copy()
+			if node._board and node._board_gen == Node._generation:
 				break
-			else:
-				history.append(node)
-				node = node.parent
+			path.append(node)
+			node = node.parent
+		path.reverse()
+
+		if node:
+			work_board = node._board.copy()
+			start = 0
+
+		else:
+
+			# Find the deepest node whose cached board is newer than every change above it.
 
-		history.reverse()
+			newest_change = 0
+			start = 0
 
-		if not work_board:
-			work_board = Board(self.width, self.height)
+			for i, node in enumerate(path):
+				if node._gen > newest_change:
+					newest_change = node._gen
+				if node._board and node._board_gen >= newest_change:
+					start = i + 1
 
-		for node in history:
+			if start == len(path):
+				self._board_gen = Node._generation	# Still good, so skip the walk next time
+				return 0
+
+			if start > 0:
+				work_board = path[start - 1]._board.copy()
+			else:
+				work_board = Board(path[0].width, path[0].height)
+
+		for node in path[start:]:
 			node.apply(work_board)
 			node._board = work_board.copy()
+			node._board_gen = Node._generation
+
+		return len(path) - start
 
 
 	def make_board(self):
@@ -423,6 +722,33 @@ class Node:
 		return ret
 
 
+	def packed_line(self):			# The moves from the root to here as a PackedLine
+
+		root = self.get_root()
+		line = PackedLine(root.width, root.height)
+		moves = line.moves
+
+		for node in self.history():
+
+			props = node.props
+
+			if "AB" in props or "AW" in props or "AE" in props or "PL" in props:
+				start = len(moves)
+				setup = [line._points(props.get(key, [])) for key in ("AB", "AW", "AE")]
+			else:
+				setup = None
+
+			for key, colour_bit in (("B", 0), ("W", packed_white)):
+				for s in props.get(key, []):
+					moves.append(line._point(s) | colour_bit)
+
+			if setup:
+				pl = props["PL"][0].lower() if "PL" in props else ""
+				line.setup.append((start, len(moves), setup[0], setup[1], setup[2], pl if pl in ["b", "w"] else ""))
+
+		return line
+
+
 	def set(self, key, value):
 
 		key = str(key)
@@ -476,6 +802,11 @@ class Node:
 		self.props[key].append(value)
 
 
+	def builder(self):				# A TreeBuilder starting here, for adding many nodes at once
+
+		return TreeBuilder(self)
+
+
 	def delete_key(self, key):
 
 		key = str(key)
@@ -518,52 +849,183 @@ class Node:
 
 		# Returns s if s is an on-board SGF string, otherwise returns ""
 
-		if not isinstance(s, str):
-			return ""
+		xy = _string_xy.get(s) if isinstance(s, str) else None
 
-		if len(s) != 2:
+		if xy and xy[0] < self.width and xy[1] < self.height:
+			return s
+		else:
 			return ""
 
-		x_ascii = ord(s[0])
-		y_ascii = ord(s[1])
 
-		if x_ascii >= 97 and x_ascii <= 122:
-			x = x_ascii - 97
-		elif x_ascii >= 65 and x_ascii <= 90:
-			x = x_ascii - 65 + 26
-		else:
-			return ""
+	# Traversals. All of these use explicit stacks or queues, so deep or huge trees are fine, and
+	# yield as they go. Depths are counted from self, which is depth 0; with max_depth given,
+	# nothing deeper than it is visited.
 
-		if y_ascii >= 97 and y_ascii <= 122:
-			y = y_ascii - 97
-		elif y_ascii >= 65 and y_ascii <= 90:
-			y = y_ascii - 65 + 26
-		else:
-			return ""
+	def preorder(self, max_depth = None):
 
-		if x >= 0 and x < self.width and y >= 0 and y < self.height:
-			return s
-		else:
-			return ""
+		if max_depth is not None:
+			for node, depth in self.preorder_with_depth(max_depth):
+				yield node
+			return
 
+		stack = [self]						# No depths needed, and no generator to pass through
 
-	def subtree_size(self):			# Including self
+		while stack:
+			node = stack.pop()
+			yield node
+			children = node.children
+			if children:
+				stack.extend(reversed(children))
+
+
+	def preorder_with_depth(self, max_depth = None):
+
+		stack = [(self, 0)]
+
+		while stack:
+			node, depth = stack.pop()
+			yield node, depth
+			if max_depth is None or depth < max_depth:
+				children = node.children
+				for i in range(len(children) - 1, -1, -1):
+					stack.append((children[i], depth + 1))
+
+
+	def postorder(self, max_depth = None):
+
+		stack = [[self, 0, 0]]				# node, depth, next child to visit
+
+		while stack:
+			item = stack[-1]
+			node, depth, i = item
+			if i < len(node.children) and (max_depth is None or depth < max_depth):
+				item[2] = i + 1
+				stack.append([node.children[i], depth + 1, 0])
+			else:
+				stack.pop()
+				yield node
+
+
+	def breadth_first(self, max_depth = None):
+
+		queue = deque([(self, 0)])
+
+		while queue:
+			node, depth = queue.popleft()
+			yield node
+			if max_depth is None or depth < max_depth:
+				for child in node.children:
+					queue.append((child, depth + 1))
+
+
+	def main_line(self, max_depth = None):
 
 		node = self
-		n = 0
+		depth = 0
 
 		while True:
+			yield node
+			if len(node.children) == 0 or (max_depth is not None and depth >= max_depth):
+				return
+			node = node.children[0]
+			depth += 1
+
+
+	def leaves_with_paths(self, max_depth = None):
+
+		# Yields (node, path) for every leaf, path being the tuple of child indices from self.
+		# With max_depth, nodes at that depth count as leaves.
+
+		stack = [[self, 0]]					# node, next child to visit
+		path = []
+
+		while stack:
+			item = stack[-1]
+			node, i = item
+			depth = len(stack) - 1
+			if len(node.children) == 0 or (max_depth is not None and depth >= max_depth):
+				yield node, tuple(path)
+				stack.pop()
+				if path:
+					path.pop()
+			elif i < len(node.children):
+				item[1] = i + 1
+				stack.append([node.children[i], 0])
+				path.append(i)
+			else:
+				stack.pop()
+				if path:
+					path.pop()
+
+
+	def __reduce__(self):
+
+		# Pickle (and deepcopy) through the flat encoding below, which neither recurses nor carries
+		# cached boards. Only the root is encoded; any other node is pickled as its root plus the
+		# path of child indices to it, so pickling many nodes of one tree stores the tree once and
+		# they come back sharing it, as with plain pickling.
+
+		if self.parent is None:
+			return (from_bytes, (self.to_bytes(),))
+
+		path = []
+		node = self
+		while node.parent:
+			path.append(node.parent.children.index(node))
+			node = node.parent
+		path.reverse()
+
+		return (_node_at_path, (node, tuple(path)))
+
+
+	def to_bytes(self):
+
+		# Encodes the whole tree this node belongs to, in pre-order, remembering which node this is.
+		# Each node is its child count and properties; see from_bytes() for the reverse.
+
+		root = self.get_root()
+		parts = []
+		count = 0
+		target = 0
+
+		for node in root.preorder():
+
+			if node is self:
+				target = count
+			count += 1
+
+			parts.append(_tree_node_header.pack(len(node.children), len(node.props)))
+
+			for key, values in node.props.items():
+				k = key.encode("utf-8")
+				parts.append(_tree_key_header.pack(len(k), len(values)))
+				parts.append(k)
+				for value in values:
+					v = value.encode("utf-8")
+					parts.append(_tree_len.pack(len(v)))
+					parts.append(v)
+
+		return _tree_header.pack(b"GF2T", 1, count, target) + b"".join(parts)
+
+
+	def subtree_size(self):			# Including self
 
+		# Order doesn't matter here, so no generator; a run of only children is followed without
+		# touching the stack.
+
+		stack = [self]
+		n = 0
+
+		while stack:
+			children = stack.pop().children
 			n += 1
+			while len(children) == 1:
+				children = children[0].children
+				n += 1
+			if children:
+				stack.extend(children)
 
-			if len(node.children) == 0:
-				return n
-			elif len(node.children) == 1:
-				node = node.children[0]
-			else:
-				for child in node.children:
-					n += child.subtree_size()
-				return n
+		return n
 
 
 	def tree_size(self):
@@ -606,140 +1068,631 @@ class Node:
 		return node
 
 
-	def _mutor_check(self, key):	# With board caches, these properties require a recursive cache clear
+	def validate_tree(self, superko = False):
 
-		if key in ["B", "W", "AB", "AW", "AE", "PL", "SZ"]:
-			self._clear_board_recursive()
+		# Replays every branch of the whole tree once, on one board that is changed on the way down
+		# and restored on the way back up, and returns a list of (path, node, key, value, problem)
+		# for every bad move or setup point, path being the tuple of child indices from the root.
+		# Problems are "off-board", "occupied", "ko", "suicide" and, if superko is set, "superko"
+		# (positional: the position after the move already occurred earlier in the line), the last
+		# only for moves with no other problem. Bad moves are otherwise handled as
+		# play_move_or_pass() does, so the positions match make_board().
 
+		root = self.get_root()
+		board = Board(root.width, root.height)
+		state = board.state
+		width = board.width
+		height = board.height
+		pass_tt = width <= 19 and height <= 19
+
+		log = []							# (x, y, old colour) for every change, for unmaking
+		problems = []
+		hashes = dict()						# Position hash --> times seen on the current line
+		h = 0
+
+		def parse(s):						# x, y, or None for a pass, or raises ValueError
+			if s == "" or (s == "tt" and pass_tt):
+				return None
+			x, y = s_to_xy(s)
+			if x < 0 or x >= width or y < 0 or y >= height:
+				raise ValueError
+			return x, y
+
+		def change(x, y, colour):
+			nonlocal h
+			old = state[x][y]
+			if old != colour:
+				log.append((x, y, old))
+				state[x][y] = colour
+				if old:
+					h ^= (zobrist_b if old == "b" else zobrist_w)[x * 52 + y]
+				if colour:
+					h ^= (zobrist_b if colour == "b" else zobrist_w)[x * 52 + y]
+
+		def report(key, value, problem):
+			problems.append((tuple(path), node, key, value, problem))
+
+		stack = [[root, 0, None]]			# node, next child to visit, undo record
+		path = []
+
+		while stack:
+
+			item = stack[-1]
+			node, i, undo = item
+
+			if undo is None:				# First visit: make the node's changes
+
+				item[2] = (len(log), board.ko, board.active, board.caps_by_b, board.caps_by_w, h)
+				props = node.props
+
+				for key, colour in (("AE", ""), ("AB", "b"), ("AW", "w")):
+					for s in props.get(key, []):
+						try:
+							xy = parse(s)
+						except:
+							xy = None
+						if xy is None:
+							report(key, s, "off-board")
+						else:
+							change(xy[0], xy[1], colour)
+					if key != "AE" and key in props:
+						board.active = "w" if colour == "b" else "b"
+
+				for key, colour in (("B", "b"), ("W", "w")):
+
+					for s in props.get(key, []):
+
+						ko = board.ko
+						board.ko = None
+						board.active = "w" if colour == "b" else "b"
+
+						try:
+							xy = parse(s)
+						except:
+							report(key, s, "off-board")
+							continue
+						if xy is None:
+							continue
+
+						x, y = xy
+						reported = len(problems)
+						if state[x][y]:
+							report(key, s, "occupied")
+						elif ko == s:
+							report(key, s, "ko")
+
+						if board._place_xy(x, y, colour, change):
+							report(key, s, "suicide")
+
+						if superko and hashes.get(h) and len(problems) == reported:
+							report(key, s, "superko")
+
+				pl = props["PL"][0] if "PL" in props else ""
+				if pl in ["B", "b"]:
+					board.active = "b"
+				elif pl in ["W", "w"]:
+					board.active = "w"
+
+				hashes[h] = hashes.get(h, 0) + 1
+				continue
 
-	def _clear_board_recursive(self):
+			if i < len(node.children):		# Go down to the next child
+				item[1] = i + 1
+				stack.append([node.children[i], 0, None])
+				path.append(i)
+				continue
 
-		node = self
+			# All children done: unmake this node's changes and go back up.
 
-		while True:
+			hashes[h] -= 1
+			length, board.ko, board.active, board.caps_by_b, board.caps_by_w, h = undo
+			while len(log) > length:
+				x, y, old = log.pop()
+				state[x][y] = old
 
-			node._board = None
+			stack.pop()
+			if path:
+				path.pop()
 
-			if len(node.children) == 0:
-				break
-			elif len(node.children) == 1:
-				node = node.children[0]
-			else:
-				for child in node.children:
-					child._clear_board_recursive()
-				break
+		return problems
 
-# -------------------------------------------------------------------------------------------------
 
-def s_to_xy(s):						# "cc" --> 2,2
+	def canonical_symmetry(self):
+		return self.make_board().canonical()[1]
 
-	if not isinstance(s, str):
-		raise TypeError
 
-	if len(s) != 2:
-		raise ValueError
+	def transform_tree(self, sym):
 
-	x_ascii = ord(s[0])
-	y_ascii = ord(s[1])
+		# Rewrites every point-valued property in the whole tree (and SZ, if the board is not square
+		# and sym transposes it) so the game becomes its image under sym. See transform_xy().
 
-	if x_ascii >= 97 and x_ascii <= 122:
-		x = x_ascii - 97
-	elif x_ascii >= 65 and x_ascii <= 90:
-		x = x_ascii - 65 + 26
-	else:
-		raise ValueError
+		root = self.get_root()
+		width, height = root.width, root.height
+		new_width, new_height = symmetry_size(sym, width, height)
 
-	if y_ascii >= 97 and y_ascii <= 122:
-		y = y_ascii - 97
-	elif y_ascii >= 65 and y_ascii <= 90:
-		y = y_ascii - 65 + 26
-	else:
-		raise ValueError
+		for node in root.preorder():
 
-	return (x, y)
+			for key, values in node.props.items():
+				if key in _point_keys:
+					node.props[key] = [_transform_point_value(v, sym, width, height) for v in values]
+				elif key in _point_pair_keys:
+					node.props[key] = [_transform_point_pair(v, sym, width, height) for v in values]
+				elif key == "LB":
+					node.props[key] = [_transform_label(v, sym, width, height) for v in values]
 
+		if new_width != width:
+			root.set("SZ", "{}:{}".format(new_width, new_height))
 
-def xy_to_s(x, y):					# 2,2 --> "cc"
+		root._invalidate()
 
-	if x < 0 or x >= 52 or y < 0 or y >= 52:
-		raise ValueError
 
-	s = ""
+	def _mutor_check(self, key):	# With board caches, these properties invalidate this node's board and its descendants
 
-	if x < 26:
-		s += chr(x + 97)
-	else:
-		s += chr(x + 65 - 26)
+		if key in ["B", "W", "AB", "AW", "AE", "PL", "SZ"]:
+			self._invalidate()
 
-	if y < 26:
-		s += chr(y + 97)
-	else:
-		s += chr(y + 65 - 26)
 
-	return s
+	def _invalidate(self):
 
+		# Nothing cached can depend on a leaf, so it's enough to drop its own board, without aging
+		# every board in the process (which would make building a game move by move quadratic,
+		# each new node's board having to check the whole path).
 
-def english_to_xy(e, height = 19, i_adjust = True):		# "Q16"     --->    15,3
+		if not self.children:
+			self._board = None
+			return
 
-	if not isinstance(e, str):
-		raise TypeError
+		Node._generation += 1
+		self._gen = Node._generation
 
-	if len(e) != 2 and len(e) != 3:
-		raise ValueError
 
-	e = e.upper()
+	def _clear_board_recursive(self):		# Frees the cached boards; not needed for correctness
 
-	if e[0] not in "ABCDEFGHIJKLMNOPQRSTUVWXYZ":
-		raise ValueError
+		for node in self.preorder():
+			node._board = None
 
-	x = ord(e[0]) - 65
+# -------------------------------------------------------------------------------------------------
 
-	if i_adjust:
-		if e[0] == "I":
-			raise ValueError
-		if x > 7:
-			x -= 1
+class TreeBuilder:
 
-	try:
-		y = height - int(e[1:])
-	except:
-		raise ValueError
+	# For making or extending trees in bulk, e.g. when converting other formats. Nodes and values
+	# are appended as given, with none of the per-call work of set() and add_value(); commit() then
+	# makes one pass over everything touched, converting values to strings, checking the nodes
+	# make sense, and invalidating cached boards once. Can be used as a context manager, which
+	# commits on a clean exit, and which also pauses the garbage collector meanwhile, since every
+	# node is part of a reference cycle and collections otherwise dominate big builds.
 
-	if y < 0 or y >= height:
-		raise ValueError
+	def __init__(self, node = None):
 
-	return (x, y)
+		self.created = dict()				# id --> node made by this builder
+		self.touched = dict()				# id --> pre-existing node whose props were changed
 
+		if node:
+			self.root = node.get_root()
+			self.node = node
+			self.node_is_new = False
+		else:
+			self.root = Node()
+			self.node = self.root
+			self.created[id(self.root)] = self.root
+			self.node_is_new = True
 
-def safe_string(s):     			# "safe" meaning safely escaped \ and ] characters
-	s = s.replace("\\", "\\\\")
-	s = s.replace("]", "\\]")
-	return s
 
+	def __enter__(self):
 
-def handicap_stones(count, width, height, tygem = False):
+		self.gc_was_enabled = gc.isenabled()
+		gc.disable()
+		return self
 
-	# From the Sabaki project by Yichuan Shen, with modifications.
-	# https://github.com/SabakiHQ/go-board
 
-	if min(width, height) <= 6 or count < 2:
-		return []
+	def __exit__(self, exc_type, exc_value, tb):
 
-	nearx = 3 if width >= 13 else 2
-	neary = 3 if height >= 13 else 2
-	farx = width - nearx - 1
-	fary = height - neary - 1
-	middlex = (width - 1) // 2
-	middley = (height - 1) // 2
+		if self.gc_was_enabled:
+			gc.enable()
+		if exc_type is None:
+			self.commit()
 
-	if tygem:
-		stones = [[nearx, fary], [farx, neary], [nearx, neary], [farx, fary]]
-	else:
-		stones = [[nearx, fary], [farx, neary], [farx, fary], [nearx, neary]]
 
-	if width % 2 != 0 and height % 2 != 0 and (width >= 9 or height >= 9):
+	def new_node(self):						# Adds a child of the current node and makes it current
 
-		if count == 5 or count == 7 or count >= 9:
+		self.node = Node(self.node)
+		self.created[id(self.node)] = self.node
+		self.node_is_new = True
+		return self.node
+
+
+	def goto(self, node):
+
+		self.node = node
+		self.node_is_new = id(node) in self.created
+
+
+	def set(self, key, value):
+
+		if not self.node_is_new:
+			self.touched[id(self.node)] = self.node
+		self.node.props[key] = [value]
+
+
+	def add_value(self, key, value):
+
+		if not self.node_is_new:
+			self.touched[id(self.node)] = self.node
+		props = self.node.props
+		if key in props:
+			props[key].append(value)
+		else:
+			props[key] = [value]
+
+
+	def commit(self):
+
+		# Stamping comes first so that the caches are right even if the checks below fail.
+
+		self._stamp_touched()
+
+		for node in list(self.created.values()) + list(self.touched.values()):
+
+			for key, values in node.props.items():
+				if type(key) is not str or not key.isalpha() or not key.isupper():
+					raise ValueError("Bad property key: {!r}".format(key))
+				for i, value in enumerate(values):
+					if type(value) is not str:
+						values[i] = str(value)
+
+			if "B" in node.props and "W" in node.props:
+				raise ValueError("Node has both B and W")
+
+		self.created = dict()
+		self.touched = dict()
+		self.node_is_new = False
+
+		return self.root
+
+
+	def _stamp_touched(self):
+
+		# New nodes have no cached boards, so only the old nodes that were changed need stamping.
+		# One new generation covers all of them.
+
+		if self.touched:
+			Node._generation += 1
+			for node in self.touched.values():
+				node._gen = Node._generation
+
+# -------------------------------------------------------------------------------------------------
+
+# A line of play packed into an array('H'), one entry per move: the point is x * 52 + y, or
+# packed_pass, and packed_white is or-ed in for White's moves. Nodes with setup stones or PL get
+# an entry in setup: (start, end, AB, AW, AE, PL) where start and end are the number of moves
+# played before and after that node, and the stones are arrays of points. Invalid moves become
+# passes and invalid setup points are dropped, as when replaying the nodes themselves.
+
+packed_pass = 0x7fff
+packed_white = 0x8000
+
+class PackedLine:
+
+	def __init__(self, width, height):
+
+		self.width = width
+		self.height = height
+		self.moves = array("H")
+		self.setup = []
+
+
+	def __len__(self):
+		return len(self.moves)
+
+
+	def _point(self, s):
+		return sgf_to_point(s, self.width, self.height)
+
+
+	def _points(self, values):
+		return array("H", [p for p in sgf_to_points(values, self.width, self.height) if p != packed_pass])
+
+
+	def numpy_moves(self):				# A uint16 view of the moves, sharing memory with the array
+
+		import numpy
+		return numpy.frombuffer(self.moves, dtype = numpy.uint16)
+
+
+	def positions(self, board = None, count = None):
+
+		# Yields (board, move) for each move, with the board as it is before the move is played.
+		# It's the same board each time, updated in place, so copy it if it's to be kept.
+
+		if board is None:
+			board = Board(self.width, self.height)
+
+		count = len(self.moves) if count is None else min(count, len(self.moves))
+		i = 0
+
+		for start, end, ab, aw, ae, pl in self.setup:
+
+			if start > count or (start == count and end > start):
+				break
+
+			yield from self._play(board, i, start)
+			i = start
+
+			state = board.state
+			for p in ae:
+				state[p // 52][p % 52] = ""
+			for p in ab:
+				state[p // 52][p % 52] = "b"
+			if ab:
+				board.active = "w"
+			for p in aw:
+				state[p // 52][p % 52] = "w"
+			if aw:
+				board.active = "b"
+
+			yield from self._play(board, i, min(end, count))
+			i = min(end, count)
+
+			if pl and end <= count:
+				board.active = pl
+
+		yield from self._play(board, i, count)
+
+
+	def _play(self, board, i, j):
+
+		moves = self.moves
+
+		for n in range(i, j):
+			move = moves[n]
+			yield board, move
+			p = move & packed_pass
+			colour = "w" if move & packed_white else "b"
+			if p == packed_pass:
+				board.play_xy(-1, -1, colour)
+			else:
+				board.play_xy(p // 52, p % 52, colour)
+
+# -------------------------------------------------------------------------------------------------
+
+# Coordinates. Conversions go through tables made once: SGF strings for every point of the largest
+# board, and per size the GTP names and the neighbours of each point. A point index is x * 52 + y,
+# as used by the Zobrist tables and PackedLine, with packed_pass for a pass or anything invalid.
+
+_sgf_chars = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+_point_strings = [a + b for a in _sgf_chars for b in _sgf_chars]			# Indexed x * 52 + y
+_string_xy = {s: (i // 52, i % 52) for i, s in enumerate(_point_strings)}
+
+_gtp_tables = dict()				# height --> [GTP name indexed x * 52 + y]
+_gtp_lookups = dict()				# (height, i_adjust) --> {name: (x, y)}
+_neighbour_tables = dict()			# (width, height) --> {s: [neighbouring s]}
+
+
+def s_to_xy(s):						# "cc" --> 2,2
+
+	ret = _string_xy.get(s)
+
+	if ret is None:
+		if not isinstance(s, str):
+			raise TypeError
+		raise ValueError
+
+	return ret
+
+
+def xy_to_s(x, y):					# 2,2 --> "cc"
+
+	if x < 0 or x >= 52 or y < 0 or y >= 52:
+		raise ValueError
+
+	return _point_strings[x * 52 + y]
+
+
+def gtp_table(height):
+
+	# GTP names of every point for this board height, indexed x * 52 + y. Columns skip "I"; as
+	# with GTP itself, only the first 25 columns have sensible names.
+
+	table = _gtp_tables.get(height)
+
+	if table is None:
+		table = []
+		for x in range(52):
+			x_ascii = x + 65
+			if x_ascii >= ord("I"):
+				x_ascii += 1
+			for y in range(52):
+				table.append(chr(x_ascii) + str(height - y))
+		_gtp_tables[height] = table
+
+	return table
+
+
+def xy_to_gtp(x, y, height):		# 2,2 --> "C17" (on 19x19)
+
+	if x < 0 or x >= 52 or y < 0 or y >= 52:
+		raise ValueError
+
+	return gtp_table(height)[x * 52 + y]
+
+
+def sgf_to_gtp(s, height):			# "cc" --> "C17" (on 19x19)
+
+	x, y = s_to_xy(s)
+	return gtp_table(height)[x * 52 + y]
+
+
+def english_to_xy(e, height = 19, i_adjust = True):		# "Q16"     --->    15,3
+
+	lookup = _gtp_lookups.get((height, i_adjust))
+
+	if lookup is None:
+		lookup = dict()
+		letters = "ABCDEFGHJKLMNOPQRSTUVWXYZ" if i_adjust else "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+		for x, letter in enumerate(letters):
+			for y in range(height):
+				lookup[letter + str(height - y)] = (x, y)
+		_gtp_lookups[(height, i_adjust)] = lookup
+
+	try:
+		ret = lookup.get(e) or lookup.get(e.upper())
+	except AttributeError:
+		raise TypeError
+
+	if ret is None:
+		return _english_to_xy_slow(e, height, i_adjust)		# For oddities like "D04", or to raise
+
+	return ret
+
+
+def _english_to_xy_slow(e, height, i_adjust):
+
+	if not isinstance(e, str):
+		raise TypeError
+
+	if len(e) != 2 and len(e) != 3:
+		raise ValueError
+
+	e = e.upper()
+
+	if e[0] not in "ABCDEFGHIJKLMNOPQRSTUVWXYZ":
+		raise ValueError
+
+	x = ord(e[0]) - 65
+
+	if i_adjust:
+		if e[0] == "I":
+			raise ValueError
+		if x > 7:
+			x -= 1
+
+	try:
+		y = height - int(e[1:])
+	except:
+		raise ValueError
+
+	if y < 0 or y >= height:
+		raise ValueError
+
+	return (x, y)
+
+
+def neighbour_table(width, height):
+
+	# {s: [neighbouring s]} for every point of the board, in the order Board.neighbours() has
+	# always used. The lists are shared, so don't change them. Boards wider or taller than 52
+	# can still be made, but points without an SGF name, or with a neighbour that has none, are
+	# left out, so that neighbours() raises ValueError for them as it always did.
+
+	table = _neighbour_tables.get((width, height))
+
+	if table is None:
+		table = dict()
+		for x in range(min(width, 52)):
+			for y in range(min(height, 52)):
+				if (x == 51 and width > 52) or (y == 51 and height > 52):
+					continue
+				ret = []
+				if x < width - 1:
+					ret.append(_point_strings[(x + 1) * 52 + y])
+				if x > 0:
+					ret.append(_point_strings[(x - 1) * 52 + y])
+				if y < height - 1:
+					ret.append(_point_strings[x * 52 + y + 1])
+				if y > 0:
+					ret.append(_point_strings[x * 52 + y - 1])
+				table[_point_strings[x * 52 + y]] = ret
+		_neighbour_tables[(width, height)] = table
+
+	return table
+
+
+def sgf_to_point(s, width = 52, height = 52):		# "cc" --> 106, or packed_pass if not on the board
+
+	xy = _string_xy.get(s) if isinstance(s, str) else None
+
+	if xy is None or xy[0] >= width or xy[1] >= height:
+		return packed_pass
+
+	return xy[0] * 52 + xy[1]
+
+
+# Batch versions, for lists of moves. Point arrays are array("H"); the point_ functions also take
+# NumPy integer arrays, and then do the arithmetic on the whole array at once.
+
+def sgf_to_points(values, width = 52, height = 52):
+
+	get = _string_xy.get
+	ret = array("H")
+
+	for s in values:
+		xy = get(s) if isinstance(s, str) else None
+		if xy is None or xy[0] >= width or xy[1] >= height:
+			ret.append(packed_pass)
+		else:
+			ret.append(xy[0] * 52 + xy[1])
+
+	return ret
+
+
+def points_to_sgf(points):			# Passes become ""
+
+	return ["" if p >= 2704 else _point_strings[p] for p in _plain_points(points)]
+
+
+def points_to_gtp(points, height):	# Passes become "pass"
+
+	table = gtp_table(height)
+	return ["pass" if p >= 2704 else table[p] for p in _plain_points(points)]
+
+
+def points_to_xy(points):
+
+	# Returns (xs, ys). For a NumPy array these are arrays, computed in one go; otherwise they're
+	# lists. Passes come out with x >= 52, so mask them out first if that matters.
+
+	if hasattr(points, "dtype"):
+		return points // 52, points % 52
+
+	return [p // 52 for p in points], [p % 52 for p in points]
+
+
+def _plain_points(points):
+	if hasattr(points, "tolist"):
+		return points.tolist()				# Python ints from a NumPy array are much faster to index with
+	return points
+
+
+def safe_string(s):     			# "safe" meaning safely escaped \ and ] characters
+	s = s.replace("\\", "\\\\")
+	s = s.replace("]", "\\]")
+	return s
+
+
+def handicap_stones(count, width, height, tygem = False):
+
+	# From the Sabaki project by Yichuan Shen, with modifications.
+	# https://github.com/SabakiHQ/go-board
+
+	if min(width, height) <= 6 or count < 2:
+		return []
+
+	nearx = 3 if width >= 13 else 2
+	neary = 3 if height >= 13 else 2
+	farx = width - nearx - 1
+	fary = height - neary - 1
+	middlex = (width - 1) // 2
+	middley = (height - 1) // 2
+
+	if tygem:
+		stones = [[nearx, fary], [farx, neary], [nearx, neary], [farx, fary]]
+	else:
+		stones = [[nearx, fary], [farx, neary], [farx, fary], [nearx, neary]]
+
+	if width % 2 != 0 and height % 2 != 0 and (width >= 9 or height >= 9):
+
+		if count == 5 or count == 7 or count >= 9:
 			stones.append([middlex, middley])
 
 		stones += [
@@ -751,6 +1704,326 @@ def handicap_stones(count, width, height, tygem = False):
 
 	return [xy_to_s(z[0], z[1]) for z in stones[0:count]]
 
+# -------------------------------------------------------------------------------------------------
+# Zobrist keys, indexed by x * 52 + y. The generator is seeded so hashes are the same in every run
+# and every process, which lets them be stored and compared.
+
+_zobrist_rng = random.Random(20220501)
+
+zobrist_b = [_zobrist_rng.getrandbits(64) for n in range(52 * 52)]
+zobrist_w = [_zobrist_rng.getrandbits(64) for n in range(52 * 52)]
+zobrist_white_to_move = _zobrist_rng.getrandbits(64)
+
+# -------------------------------------------------------------------------------------------------
+# The 8 symmetries of the board, numbered so that bit 1 flips x, bit 2 flips y, and bit 4 then
+# swaps x and y. The last 4 turn a width x height board into height x width.
+
+def transform_xy(x, y, sym, width, height):
+
+	if sym & 1:
+		x = width - 1 - x
+	if sym & 2:
+		y = height - 1 - y
+	if sym & 4:
+		x, y = y, x
+	return (x, y)
+
+
+def symmetry_size(sym, width, height):
+	if sym & 4:
+		return (height, width)
+	return (width, height)
+
+
+def inverse_symmetry(sym):
+	if sym == 5:						# Only the two quarter-turns aren't their own inverses
+		return 6
+	if sym == 6:
+		return 5
+	return sym
+
+
+def transform_s(s, sym, width, height):
+
+	# Passes and other off-board strings come back unchanged.
+
+	try:
+		x, y = s_to_xy(s)
+	except:
+		return s
+
+	if x < 0 or x >= width or y < 0 or y >= height:
+		return s
+
+	x, y = transform_xy(x, y, sym, width, height)
+	return xy_to_s(x, y)
+
+
+_point_keys = {"B", "W", "AB", "AW", "AE", "TR", "SQ", "CR", "MA", "SL", "TB", "TW", "DD", "VW"}
+_point_pair_keys = {"AR", "LN"}
+
+
+def _transform_point_value(v, sym, width, height):
+
+	if ":" not in v:
+		return transform_s(v, sym, width, height)
+
+	# A compressed rectangle like "aa:cc", whose corners need putting back in order afterwards.
+
+	a, b = v.split(":", 1)
+	try:
+		x1, y1 = s_to_xy(transform_s(a, sym, width, height))
+		x2, y2 = s_to_xy(transform_s(b, sym, width, height))
+	except ValueError:
+		return v
+
+	return xy_to_s(min(x1, x2), min(y1, y2)) + ":" + xy_to_s(max(x1, x2), max(y1, y2))
+
+
+def _transform_point_pair(v, sym, width, height):
+	if ":" not in v:
+		return v
+	a, b = v.split(":", 1)
+	return transform_s(a, sym, width, height) + ":" + transform_s(b, sym, width, height)
+
+
+def _transform_label(v, sym, width, height):
+	if ":" not in v:
+		return v
+	a, text = v.split(":", 1)
+	return transform_s(a, sym, width, height) + ":" + text
+
+# -------------------------------------------------------------------------------------------------
+
+_tree_header = struct.Struct("<4sBII")			# magic, version, node count, index of the wanted node
+_tree_node_header = struct.Struct("<IH")		# child count, key count
+_tree_key_header = struct.Struct("<II")		# key length, value count
+_tree_len = struct.Struct("<I")
+
+
+def from_bytes(buf):
+
+	# Rebuilds a tree made by Node.to_bytes() and returns the node that was encoded.
+
+	magic, version, count, target = _tree_header.unpack_from(buf, 0)
+
+	if magic != b"GF2T" or version != 1:
+		raise ParserFail("Not an encoded tree")
+
+	buf = memoryview(buf)
+	off = _tree_header.size
+	stack = []										# [node, children still to come]
+	ret = None
+	root = None
+
+	for i in range(count):
+
+		child_count, key_count = _tree_node_header.unpack_from(buf, off)
+		off += _tree_node_header.size
+
+		while stack and stack[-1][1] == 0:
+			stack.pop()
+
+		if stack:
+			stack[-1][1] -= 1
+			node = Node(stack[-1][0])
+		else:
+			node = Node()
+			root = node
+
+		props = node.props
+
+		for j in range(key_count):
+			klen, value_count = _tree_key_header.unpack_from(buf, off)
+			off += _tree_key_header.size
+			key = str(buf[off:off + klen], "utf-8")
+			off += klen
+			values = []
+			for n in range(value_count):
+				vlen, = _tree_len.unpack_from(buf, off)
+				off += 4
+				values.append(str(buf[off:off + vlen], "utf-8"))
+				off += vlen
+			props[key] = values
+
+		if i == target:
+			ret = node
+
+		if child_count > 0:
+			stack.append([node, child_count])
+
+	return ret
+
+
+def _node_at_path(root, path):		# For unpickling nodes other than the root
+
+	node = root
+	for i in path:
+		node = node.children[i]
+	return node
+
+# -------------------------------------------------------------------------------------------------
+# Positions in shared memory, for handing replayed games between processes without pickling.
+# A block holds boards of one size in a fixed layout:
+#
+#   header | game index (start, count) as uint32 pairs | active | ko | stones
+#
+# where active is 1 (Black to move) or 2, ko is an (x, y) pair of uint8 with 255 for none, and
+# stones are 0 / 1 / 2 (empty / Black / White) in [y][x] order, so stones_view()[i] is board i
+# the way it's drawn. The views need NumPy; writing and read_board() don't.
+
+class SharedPositions:
+
+	_header = struct.Struct("<4sBHHIIII")		# magic, version, width, height, capacity, max games, count, games
+	_header_size = 32
+
+	def __init__(self, width, height, capacity, max_games = 1, name = None, _shm = None):
+
+		self.width = width
+		self.height = height
+		self.capacity = capacity
+		self.max_games = max_games
+
+		self.index_off = self._header_size
+		self.active_off = self.index_off + 8 * max_games
+		self.ko_off = self.active_off + capacity
+		self.stones_off = (self.ko_off + 2 * capacity + 7) // 8 * 8
+		size = self.stones_off + capacity * width * height
+
+		if _shm:
+			self.shm = _shm
+			self.refresh()
+		else:
+			self.shm = shared_memory.SharedMemory(name = name, create = True, size = size)
+			self.count = 0
+			self.games = 0
+			self._write_header()
+
+		self.name = self.shm.name
+
+
+	@classmethod
+	def attach(cls, name):
+
+		shm = shared_memory.SharedMemory(name = name)
+		magic, version, width, height, capacity, max_games, count, games = cls._header.unpack_from(shm.buf, 0)
+
+		if magic != b"GFSP" or version != 1:
+			shm.close()
+			raise ValueError("Not a position block")
+
+		return cls(width, height, capacity, max_games, _shm = shm)
+
+
+	def _write_header(self):
+		self._header.pack_into(self.shm.buf, 0, b"GFSP", 1, self.width, self.height, self.capacity, self.max_games, self.count, self.games)
+
+
+	def add_board(self, board):
+
+		if board.width != self.width or board.height != self.height:
+			raise ValueError("Board size doesn't match the block")
+		if self.count >= self.capacity:
+			raise ValueError("Block is full")
+
+		i = self.count
+		buf = self.shm.buf
+
+		buf[self.active_off + i] = 1 if board.active == "b" else 2
+
+		if board.ko:
+			ko_x, ko_y = s_to_xy(board.ko)
+		else:
+			ko_x, ko_y = 255, 255
+		buf[self.ko_off + 2 * i] = ko_x
+		buf[self.ko_off + 2 * i + 1] = ko_y
+
+		codes = {"": 0, "b": 1, "w": 2}
+		row = bytearray(self.width)
+		off = self.stones_off + i * self.width * self.height
+
+		for y in range(self.height):
+			for x in range(self.width):
+				row[x] = codes[board.state[x][y]]
+			buf[off:off + self.width] = row
+			off += self.width
+
+		self.count += 1
+		self._write_header()
+		return i
+
+
+	def add_game(self, node):
+
+		# Writes every position from the root to the end of node's main line (root included), in
+		# one replay rather than a make_board() per node. Returns the game's number.
+
+		if self.games >= self.max_games:
+			raise ValueError("Game index is full")
+
+		start = self.count
+		board = Board(self.width, self.height)
+
+		for n in node.get_end().history():
+			n.apply(board)
+			self.add_board(board)
+
+		struct.pack_into("<II", self.shm.buf, self.index_off + 8 * self.games, start, self.count - start)
+		self.games += 1
+		self._write_header()
+		return self.games - 1
+
+
+	def game_range(self, game):
+		start, count = struct.unpack_from("<II", self.shm.buf, self.index_off + 8 * game)
+		return (start, count)
+
+
+	def read_board(self, i):
+
+		buf = self.shm.buf
+		board = Board(self.width, self.height, active = "b" if buf[self.active_off + i] == 1 else "w")
+
+		ko_x, ko_y = buf[self.ko_off + 2 * i], buf[self.ko_off + 2 * i + 1]
+		if ko_x != 255:
+			board.ko = xy_to_s(ko_x, ko_y)
+
+		colours = ["", "b", "w"]
+		off = self.stones_off + i * self.width * self.height
+
+		for y in range(self.height):
+			for x in range(self.width):
+				board.state[x][y] = colours[buf[off + y * self.width + x]]
+
+		return board
+
+
+	def stones_view(self):
+		import numpy
+		return numpy.ndarray((self.capacity, self.height, self.width), numpy.uint8, self.shm.buf, self.stones_off)[:self.count]
+
+
+	def active_view(self):
+		import numpy
+		return numpy.ndarray((self.capacity,), numpy.uint8, self.shm.buf, self.active_off)[:self.count]
+
+
+	def ko_view(self):
+		import numpy
+		return numpy.ndarray((self.capacity, 2), numpy.uint8, self.shm.buf, self.ko_off)[:self.count]
+
+
+	def refresh(self):					# A reader calls this to see positions added since it attached
+		self.count, self.games = self._header.unpack_from(self.shm.buf, 0)[6:8]
+
+
+	def close(self):
+		self.shm.close()
+
+
+	def unlink(self):
+		self.shm.unlink()
+
 # -------------------------------------------------------------------------------------------------
 
 def save(filename, node):
@@ -760,24 +2033,30 @@ def save(filename, node):
 
 
 def _write_tree(outfile, node):
-	outfile.write("(")
-	while True:
+
+	# A node opens a new "(" if it's where we started or one of several siblings. Each open
+	# variation is remembered by the depth it started at, and closed when the walk comes back up
+	# to that depth or above.
+
+	open_depths = []
+
+	for node, depth in node.preorder_with_depth():
+
+		while open_depths and open_depths[-1] >= depth:
+			outfile.write(")")
+			open_depths.pop()
+
+		if depth == 0 or len(node.parent.children) > 1:
+			outfile.write("(")
+			open_depths.append(depth)
+
 		outfile.write(";")
 		for key in node.props:
 			outfile.write(key)
 			for value in node.props[key]:
 				outfile.write("[{}]".format(safe_string(value)))
-		if len(node.children) > 1:
-			for child in node.children:
-				_write_tree(outfile, child)
-			break
-		elif len(node.children) == 1:
-			node = node.children[0]
-			continue
-		else:
-			break
-	outfile.write(")")
-	return
+
+	outfile.write(")" * len(open_depths))
 
 
 def load(filename):
@@ -916,13 +2195,75 @@ def _load_sgf_recursive(buf, off, parent_of_local_root):
 	raise ParserFail("SGF load error: Reached end of input")
 
 
+# NGF and GIB files are read as bytes. Only the lines that matter are looked at, and only the
+# header lines and GAMETAG are decoded. Besides the tree loaders, ngf_moves() and gib_moves()
+# return the game as a PackedLine (handicap stones as setup on the first entry), and ngf_header()
+# and gib_header() return just the root properties, as {key: [values]}.
+
 def load_ngf(buf):
 
-	lines = [z.decode(encoding="utf-8", errors="replace").strip() for z in buf.split(b"\n")]
+	lines = buf.split(b"\n")
+	boardsize, header = _ngf_header(lines)
+
+	with TreeBuilder() as builder:
+
+		for key, values in header.items():
+			for value in values:
+				builder.add_value(key, value)
+
+		for key, x, y in _ngf_moves(lines):
+
+			builder.new_node()
+
+			if x >= 0 and x < boardsize and y >= 0 and y < boardsize:
+				builder.set(key, xy_to_s(x, y))
+			else:
+				builder.set(key, "")	# Pass
+
+	root = builder.root
+
+	if len(root.children) == 0:
+		raise ParserFail("NGF load error: Got no moves")
+
+	return [root]
+
+
+def ngf_header(buf):
+	return _ngf_header(buf.split(b"\n", 11))[1]
+
+
+def ngf_moves(buf):
+
+	lines = buf.split(b"\n")
+	boardsize, header = _ngf_header(lines)
+
+	size = max(1, min(boardsize, 52))
+	line = PackedLine(size, size)
+	moves = line.moves
+
+	if "AB" in header:
+		line.setup.append((0, 0, line._points(header["AB"]), array("H"), array("H"), ""))
+
+	for key, x, y in _ngf_moves(lines):
+		colour_bit = packed_white if key == "W" else 0
+		if x >= 0 and x < size and y >= 0 and y < size:
+			moves.append(x * 52 + y | colour_bit)
+		else:
+			moves.append(packed_pass | colour_bit)
+
+	if len(moves) == 0:
+		raise ParserFail("NGF load error: Got no moves")
+
+	return line
+
+
+def _ngf_header(lines):
 
 	if len(lines) < 12:
 		raise ParserFail("NGF load error: File too short")
 
+	lines = [z.decode(encoding="utf-8", errors="replace").strip() for z in lines[:11]]
+
 	# ---------------------------------------------------------------------------------------------
 
 	try:
@@ -993,17 +2334,11 @@ def load_ngf(buf):
 
 	# ---------------------------------------------------------------------------------------------
 
-	root = Node()
-	node = root
-
-	root.set("SZ", boardsize)
-	root.set("RU", "Korean")
-	root.set("KM", komi)
+	props = {"SZ": [str(boardsize)], "RU": ["Korean"], "KM": [str(komi)]}
 
 	if handicap > 1:
-		root.set("HA", handicap)
-		for s in handicap_stones(handicap, boardsize, boardsize, True):
-			root.add_value("AB", s)
+		props["HA"] = [str(handicap)]
+		props["AB"] = handicap_stones(handicap, boardsize, boardsize, True)
 
 	if len(rawdate) == 8:
 		ok = True
@@ -1011,112 +2346,208 @@ def load_ngf(buf):
 			if rawdate[n] < "0" or rawdate[n] > "9":
 				ok = False
 		if ok:
-			root.set("DT", rawdate[0:4] + "-" + rawdate[4:6] + "-" + rawdate[6:8])
+			props["DT"] = [rawdate[0:4] + "-" + rawdate[4:6] + "-" + rawdate[6:8]]
 
 	if pw:
-		root.set("PW", pw)
+		props["PW"] = [pw]
 	if pb:
-		root.set("PB", pb)
+		props["PB"] = [pb]
 	if re:
-		root.set("RE", re)
+		props["RE"] = [re]
 
-	for line in lines:
+	return boardsize, props
+
+
+def _ngf_moves(lines):
 
-		line = line.upper()
+	# Yields (key, x, y) for every move line, which looks like "PMxxByz" (any case), where y and z
+	# are the coordinates with "B" being 0. The callers treat anything off the board as a pass.
+
+	for line in lines:
 
 		if len(line) < 7:
 			continue
 
-		if line[0:2] == "PM":
+		line = line.strip()[0:7].upper()
 
-			if line[4] == "B" or line[4] == "W":
+		if len(line) < 7 or line[0:2] != b"PM":
+			continue
 
-				key = line[4]
+		if line[4] == 66:					# "B"
+			yield "B", line[5] - 66, line[6] - 66
+		elif line[4] == 87:					# "W"
+			yield "W", line[5] - 66, line[6] - 66
 
-				x = ord(line[5]) - 66
-				y = ord(line[6]) - 66
 
-				node = Node(node)
+def load_gib(buf):
 
-				if x >= 0 and x < boardsize and y >= 0 and y < boardsize:
-					node.set(key, xy_to_s(x, y))
-				else:
-					node.set(key, "")		# Pass
+	with TreeBuilder() as builder:
 
-	if len(root.children) == 0:
-		raise ParserFail("NGF load error: Got no moves")
+		root = builder.root
 
-	return [root]
+		builder.set("SZ", 19)						# Is this always so?
+		builder.set("RU", "Korean")
+		builder.set("KM", 0)						# Can get adjusted in a moment.
 
+		for kind, item in _gib_lines(buf.split(b"\n")):
 
-def load_gib(buf):
+			# Moves...
 
-	lines = [z.decode(encoding="utf-8", errors="replace").strip() for z in buf.split(b"\n")]
+			if kind == "STO":
 
-	root = Node()
-	node = root
+				try:
+					x = int(item[4])
+					y = int(item[5])
+					key = "W" if item[3] == b"2" else "B"
+					builder.new_node()
+					builder.set(key, xy_to_s(x, y))
+				except:
+					pass
 
-	root.set("SZ", 19)								# Is this always so?
-	root.set("RU", "Korean")
-	root.set("KM", 0)								# Can get adjusted in a moment.
+			# Handicap...
 
-	for line in lines:
+			elif kind == "INI":
 
-		# Game info...
+				if builder.node is not root:
+					raise ParserFail("GIB load error: Got INI after moves were made")
 
-		if line.startswith("\\[GAMETAG="):
+				try:
+					handicap = int(item[3])
+					if handicap > 1:
+						builder.set("HA", handicap)
+						for s in handicap_stones(handicap, 19, 19, True):
+							builder.add_value("AB", s)
+				except:
+					pass
 
-			dt, re, km, pb, pw = parse_gib_gametag(line)
+			# Game info...
 
-			if dt:
-				root.set("DT", dt)
-			if re:
-				root.set("RE", re)
-			if km:
-				root.set("KM", km)
+			else:
 
-			if pb and "�" not in pb:
-				root.set("PB", pb)
-			if pw and "�" not in pw:
-				root.set("PW", pw)
+				current = builder.node
+				builder.goto(root)
 
-		# Split the line into tokens for the handicap and move parsing...
+				for key, value in _gib_gametag_props(item):
+					builder.set(key, value)
 
-		fields = line.split()
+				builder.goto(current)
 
-		# Handicap...
+	if len(root.children) == 0:
+		raise ParserFail("GIB load error: got no moves")
 
-		if len(fields) >= 4 and fields[0] == "INI":
+	return [root]
 
-			if node != root:
-				raise ParserFail("GIB load error: Got INI after moves were made")
 
+def gib_header(buf):
+
+	props = {"SZ": ["19"], "RU": ["Korean"], "KM": ["0"]}
+
+	for kind, item in _gib_lines(buf.split(b"\n")):
+		if kind == "STO":
+			break
+		elif kind == "INI":
 			try:
-				handicap = int(fields[3])
+				handicap = int(item[3])
 				if handicap > 1:
-					root.set("HA", handicap)
-					for s in handicap_stones(handicap, 19, 19, True):
-						root.add_value("AB", s)
+					props["HA"] = [str(handicap)]
+					props["AB"] = props.get("AB", []) + handicap_stones(handicap, 19, 19, True)
 			except:
 				pass
+		else:
+			for key, value in _gib_gametag_props(item):
+				props[key] = [value]
+
+	return props
+
+
+def gib_moves(buf):
 
-		# Moves...
+	line = PackedLine(19, 19)
+	moves = line.moves
+	handicap_points = array("H")
+	nodes = 0
 
-		if len(fields) >= 6 and fields[0] == "STO":
+	for kind, item in _gib_lines(buf.split(b"\n")):
+
+		if kind == "STO":
+
+			try:
+				x = int(item[4])
+				y = int(item[5])
+			except:
+				continue
+
+			nodes += 1
+			colour_bit = packed_white if item[3] == b"2" else 0
+
+			if x >= 0 and x < 19 and y >= 0 and y < 19:
+				moves.append(x * 52 + y | colour_bit)
+			elif x >= 0 and x < 52 and y >= 0 and y < 52:
+				moves.append(packed_pass | colour_bit)
+			# else the tree loader leaves an empty node, so there's no move
+
+		elif kind == "INI":
+
+			if nodes:
+				raise ParserFail("GIB load error: Got INI after moves were made")
 
 			try:
-				x = int(fields[4])
-				y = int(fields[5])
-				key = "W" if fields[3] == "2" else "B"
-				node = Node(node)
-				node.set(key, xy_to_s(x, y))
+				handicap = int(item[3])
+				if handicap > 1:
+					handicap_points += line._points(handicap_stones(handicap, 19, 19, True))
 			except:
 				pass
 
-	if len(root.children) == 0:
+	if nodes == 0:
 		raise ParserFail("GIB load error: got no moves")
 
-	return [root]
+	if handicap_points:
+		line.setup.append((0, 0, handicap_points, array("H"), array("H"), ""))
+
+	return line
+
+
+def _gib_lines(lines):
+
+	# Yields ("STO", fields) and ("INI", fields) for move and handicap lines, with the fields
+	# still as bytes, and ("GAMETAG", line) with the line decoded. Other lines are skipped.
+
+	for line in lines:
+
+		line = line.strip()
+
+		if line.startswith(b"STO"):
+			fields = line.split()
+			if len(fields) >= 6 and fields[0] == b"STO":
+				yield "STO", fields
+
+		elif line.startswith(b"INI"):
+			fields = line.split()
+			if len(fields) >= 4 and fields[0] == b"INI":
+				yield "INI", fields
+
+		elif line.startswith(b"\\[GAMETAG="):
+			yield "GAMETAG", line.decode(encoding="utf-8", errors="replace")
+
+
+def _gib_gametag_props(line):
+
+	ret = []
+	dt, re, km, pb, pw = parse_gib_gametag(line)
+
+	if dt:
+		ret.append(("DT", dt))
+	if re:
+		ret.append(("RE", re))
+	if km:
+		ret.append(("KM", km))
+
+	if pb and "�" not in pb:
+		ret.append(("PB", pb))
+	if pw and "�" not in pw:
+		ret.append(("PW", pw))
+
+	return ret
 
 
 def parse_gib_gametag(line):
@@ -1186,3 +2617,139 @@ def parse_gib_gametag(line):
 			re += str(zipsu / 10)
 
 	return [dt, re, km, pb, pw]
+
+# -------------------------------------------------------------------------------------------------
+
+# Optional counters, for finding out where a slow job spends its time. enable_counters() swaps
+# counting wrappers in for the methods and loaders concerned, and disable_counters() puts the
+# originals back, so when they're off nothing is counted and nothing is paid.
+
+counters = dict()
+_uncounted = dict()					# (owner, name) --> original, while counting is on
+
+_parser_formats = ["sgf", "gib", "ngf"]
+
+
+def reset_counters():
+
+	counters.clear()
+	counters.update({
+		"board_copy": 0,
+		"liberty_visits": 0,			# Calls of _has_liberties_recurse
+		"destroyed_stones": 0,
+		"cache_hits": 0,				# _cache_board calls that made no boards
+		"cache_misses": 0,
+		"cache_replayed_nodes": 0,		# Boards made by the misses
+		"generation_bumps": 0,			# Non-leaf changes, each aging every cached board a little
+		"leaf_boards_dropped": 0,		# Leaf changes, which only drop the leaf's own board
+		"builder_nodes_stamped": 0,		# Old nodes changed through a TreeBuilder, by commit()
+	})
+	for fmt in _parser_formats:
+		counters["parse_bytes_" + fmt] = 0
+		counters["parse_seconds_" + fmt] = 0.0
+
+
+def counter_snapshot():
+
+	ret = dict(counters)
+	for fmt in _parser_formats:
+		seconds = ret.get("parse_seconds_" + fmt, 0)
+		ret["parse_bytes_per_second_" + fmt] = ret.get("parse_bytes_" + fmt, 0) / seconds if seconds > 0 else 0
+	return ret
+
+
+def enable_counters():
+
+	if _uncounted:
+		return
+
+	if not counters:
+		reset_counters()
+
+	def wrap(cls, name, make_wrapper):			# cls None means a module-level function
+		original = cls.__dict__[name] if cls else globals()[name]
+		_uncounted[(cls, name)] = original
+		if cls:
+			setattr(cls, name, make_wrapper(original))
+		else:
+			globals()[name] = make_wrapper(original)
+
+	def count_copy(original):
+		def copy(self):
+			counters["board_copy"] += 1
+			return original(self)
+		return copy
+
+	def count_liberties(original):
+		def _has_liberties_recurse(self, s, touched):
+			counters["liberty_visits"] += 1
+			return original(self, s, touched)
+		return _has_liberties_recurse
+
+	def count_destroy(original):
+		def destroy_group(self, s):		# Each call that removes anything removes one stone itself
+			if self.state_at(s):
+				counters["destroyed_stones"] += 1
+			return original(self, s)
+		return destroy_group
+
+	def count_cache(original):
+		def _cache_board(self):
+			made = original(self)
+			if made:
+				counters["cache_misses"] += 1
+				counters["cache_replayed_nodes"] += made
+			else:
+				counters["cache_hits"] += 1
+			return made
+		return _cache_board
+
+	def count_invalidate(original):
+		def _invalidate(self):
+			if self.children:
+				counters["generation_bumps"] += 1
+			else:
+				counters["leaf_boards_dropped"] += 1
+			return original(self)
+		return _invalidate
+
+	def count_stamp(original):
+		def _stamp_touched(self):
+			if self.touched:
+				counters["generation_bumps"] += 1
+				counters["builder_nodes_stamped"] += len(self.touched)
+			return original(self)
+		return _stamp_touched
+
+	def count_parser(fmt):
+		def make_wrapper(original):
+			def loader(buf):
+				t = time.perf_counter()
+				try:
+					return original(buf)
+				finally:
+					counters["parse_seconds_" + fmt] += time.perf_counter() - t
+					counters["parse_bytes_" + fmt] += len(buf)
+			return loader
+		return make_wrapper
+
+	wrap(Board, "copy", count_copy)
+	wrap(Board, "_has_liberties_recurse", count_liberties)
+	wrap(Board, "destroy_group", count_destroy)
+	wrap(Node, "_cache_board", count_cache)
+	wrap(Node, "_invalidate", count_invalidate)
+	wrap(TreeBuilder, "_stamp_touched", count_stamp)
+
+	for fmt in _parser_formats:
+		wrap(None, "load_" + fmt, count_parser(fmt))
+
+
+def disable_counters():				# The counts are kept until reset_counters()
+
+	for (cls, name), original in _uncounted.items():
+		if cls:
+			setattr(cls, name, original)
+		else:
+			globals()[name] = original
+
+	_uncounted.clear()
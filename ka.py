@@ -1,4 +1,10 @@
-import gofish2, subprocess, sys, threading, time
+import argparse, bisect, dbm, gofish2, hashlib, json, os, queue, shlex, socket, socketserver, subprocess, sys, tempfile, threading, time
+from array import array
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
 
 # This was just an experiment to see how fast GTP is or isn't.
 # Limitations: no illegal board edits.
@@ -18,17 +24,151 @@ def relay_pipe(pipe, output_stream):
 		output_stream.write(b.decode("utf8"))
 
 # -------------------------------------------------------------------------------------------------
+# Instrumentation for the engine client. A KataGo object has stats = None unless asked for, and
+# every hook is behind an "if self.stats:" test, so leaving it off costs next to nothing.
 
-class KataGo():
+latency_buckets = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+class Histogram():
+
+	def __init__(self, bounds = latency_buckets):
+		self.bounds = bounds
+		self.counts = [0] * (len(bounds) + 1)		# Last one is +Inf
+		self.sum = 0.0
+		self.count = 0
+
+	def observe(self, value):
+		self.counts[bisect.bisect_left(self.bounds, value)] += 1
+		self.sum += value
+		self.count += 1
+
+	def snapshot(self):
+		return {"count": self.count, "sum": self.sum, "buckets": list(zip(self.bounds + ["+Inf"], self.counts))}
+
+	def prometheus(self, name, labels = ""):
+		lines = []
+		cumulative = 0
+		sep = "," if labels else ""
+		for bound, n in zip(self.bounds + ["+Inf"], self.counts):
+			cumulative += n
+			lines.append('{}_bucket{{{}{}le="{}"}} {}'.format(name, labels, sep, bound, cumulative))
+		lines.append("{}_sum{} {}".format(name, "{" + labels + "}" if labels else "", self.sum))
+		lines.append("{}_count{} {}".format(name, "{" + labels + "}" if labels else "", self.count))
+		return lines
+
+
+class Stats():
 
 	def __init__(self):
+		self.lock = threading.Lock()
+		self.pending = dict()					# msg id --> (command name, send time)
+		self.query_start = dict()				# kata-analyze msg id --> send time
+		self.awaiting_info = set()				# kata-analyze msg ids with no info line yet
+		self.commands = dict()					# command name --> Histogram of reply latency
+		self.first_info = Histogram()
+		self.analysis_visits = 0
+		self.analysis_seconds = 0.0
+		self.last_visits_per_second = 0.0
+		self.queue_depth = 0
+		self.queue_depth_max = 0
 
-		self.last_sent_msg_id = None			# Will be an int when valid
-		self.last_received_msg_id = None		# Will be an int when valid
-		self.first_receive_time = None
+	def sent(self, msg_id, msg):
+		fields = msg.split(None, 1)
+		cmd = fields[0] if fields else ""
+		t = time.perf_counter()
+		with self.lock:
+			self.pending[msg_id] = (cmd, t)
+			if cmd == "kata-analyze":
+				self.query_start[msg_id] = t
+				self.awaiting_info.add(msg_id)
+
+	def replied(self, msg_id):
+		t = time.perf_counter()
+		with self.lock:
+			item = self.pending.pop(msg_id, None)
+			if item:
+				cmd, sent_time = item
+				if cmd not in self.commands:
+					self.commands[cmd] = Histogram()
+				self.commands[cmd].observe(t - sent_time)
+
+	def info(self, msg_id):
+		if msg_id not in self.awaiting_info:	# Cheap test first, it's nearly always this
+			return
+		t = time.perf_counter()
+		with self.lock:
+			if msg_id in self.awaiting_info:
+				self.awaiting_info.discard(msg_id)
+				self.first_info.observe(t - self.query_start[msg_id])
+
+	def analysis_done(self, msg_id, visits):
+		t = time.perf_counter()
+		with self.lock:
+			start = self.query_start.pop(msg_id, None)
+			self.awaiting_info.discard(msg_id)
+			if start is not None and t > start:
+				self.analysis_visits += visits
+				self.analysis_seconds += t - start
+				self.last_visits_per_second = visits / (t - start)
+
+	def queued(self, depth):
+		self.queue_depth = depth
+		if depth > self.queue_depth_max:
+			self.queue_depth_max = depth
+
+	def snapshot(self):
+		with self.lock:
+			return {
+				"commands": {cmd: h.snapshot() for cmd, h in self.commands.items()},
+				"first_info": self.first_info.snapshot(),
+				"analysis_visits": self.analysis_visits,
+				"analysis_seconds": self.analysis_seconds,
+				"visits_per_second": self.analysis_visits / self.analysis_seconds if self.analysis_seconds > 0 else 0.0,
+				"last_visits_per_second": self.last_visits_per_second,
+				"in_flight": len(self.pending),
+				"queue_depth": self.queue_depth,
+				"queue_depth_max": self.queue_depth_max,
+			}
+
+	def prometheus(self):
+
+		with self.lock:
+
+			lines = ["# TYPE ka_gtp_command_seconds histogram"]
+			for cmd in sorted(self.commands):
+				lines += self.commands[cmd].prometheus("ka_gtp_command_seconds", 'command="{}"'.format(cmd))
+
+			lines.append("# TYPE ka_first_info_seconds histogram")
+			lines += self.first_info.prometheus("ka_first_info_seconds")
+
+			for name, kind, value in [
+				("ka_analysis_visits_total", "counter", self.analysis_visits),
+				("ka_analysis_seconds_total", "counter", self.analysis_seconds),
+				("ka_visits_per_second", "gauge", self.last_visits_per_second),
+				("ka_commands_in_flight", "gauge", len(self.pending)),
+				("ka_response_queue_depth", "gauge", self.queue_depth),
+				("ka_response_queue_depth_max", "gauge", self.queue_depth_max),
+			]:
+				lines.append("# TYPE {} {}".format(name, kind))
+				lines.append("{} {}".format(name, value))
+
+			return "\n".join(lines) + "\n"
+
+# -------------------------------------------------------------------------------------------------
+
+class KataGo():
+
+	# A reader thread drains stdout all the time, so the engine never blocks on a full pipe.
+	# Analysis lines ("info ...") overwrite a single latest-snapshot slot per query, so the
+	# consumer only ever parses the freshest one. Other responses are queued only if command() is
+	# waiting for them; the rest (e.g. replies to kata-analyze and stop) are dropped, with errors
+	# among them reported on stderr, so the bounded queue can never fill up and stall the reader.
+
+	def __init__(self, command = None, stats = False):
 
 		self.p = subprocess.Popen(
-			[exe_path] + args,
+			command or [exe_path] + args,
 			stdin = subprocess.PIPE,
 			stdout = subprocess.PIPE,
 			stderr = subprocess.PIPE)
@@ -36,139 +176,1136 @@ class KataGo():
 		# Thread to output stderr only...
 		threading.Thread(target = relay_pipe, args = [self.p.stderr, sys.stderr], daemon = True).start()
 
-	def send(self, msg):
+		self._begin(self.p.stdin, self.p.stdout, stats)
+
+	def _begin(self, stdin, stdout, stats = False):
+
+		self.stdin = stdin
+		self.stdout = stdout
+		self.stats = Stats() if stats else None
+
+		self.last_sent_msg_id = None			# Will be an int when valid
+		self.last_received_msg_id = None		# Will be an int when valid
+		self.wanted_msg_id = None				# The id command() is waiting on, if any
+		self.first_receive_time = None
+		self.echo = True						# Print commands as they are sent
+
+		self.responses = queue.Queue(maxsize = 1024)
+		self.latest = dict()					# query id --> newest unconsumed info line, or None
+		self.latest_cond = threading.Condition()
+		self.closed = False
+
+		threading.Thread(target = self._read_stdout, daemon = True).start()
+
+	def send(self, msg, want_reply = False):
 
 		if self.last_sent_msg_id:
 			msg_id = self.last_sent_msg_id + 1
 		else:
 			msg_id = 1
 
+		if want_reply:
+			self.wanted_msg_id = msg_id			# Before writing, so the reply can't arrive first
+
+		if self.stats:
+			self.stats.sent(msg_id, msg)
+
 		msg = str(msg_id) + " " + msg.strip() + "\n"
-		print("--> " + msg, end = "")
-		self.p.stdin.write(msg.encode("utf8"))
-		self.p.stdin.flush()
+		if self.echo:
+			print("--> " + msg, end = "")
+		self.last_sent_msg_id = msg_id			# Before writing, so the reader never sees a reply to an unknown id
+
+		self.stdin.write(msg.encode("utf8"))
+		self.stdin.flush()
+
+	def _read_stdout(self):
+
+		current_id = None
+
+		while True:
+
+			b = self.stdout.readline()
+
+			if not b:
+				break
+
+			if not self.first_receive_time:
+				self.first_receive_time = time.monotonic()
+
+			msg = b.decode("utf8").rstrip()		# It would end with \n otherwise
+
+			if msg.startswith("info"):
+				if self.stats:
+					self.stats.info(current_id)
+				if current_id == self.last_sent_msg_id:
+					with self.latest_cond:
+						if current_id not in self.latest:
+							self.latest.clear()
+						self.latest[current_id] = msg
+						self.latest_cond.notify_all()
+				continue
 
-		self.last_sent_msg_id = msg_id
+			if msg.startswith("=") or msg.startswith("?"):
+				try:
+					i = msg.index(" ")
+				except:
+					i = len(msg)
+				try:
+					current_id = int(msg[1:i])
+				except:
+					pass
+				if self.stats:
+					self.stats.replied(current_id)
+
+			if current_id is not None and current_id == self.wanted_msg_id:
+				self.responses.put((current_id, msg))
+				if self.stats:
+					self.stats.queued(self.responses.qsize())
+			elif msg.startswith("?"):
+				print("Unread engine error: " + msg, file = sys.stderr)
+
+		with self.latest_cond:
+			self.closed = True
+			self.latest_cond.notify_all()
+		self.responses.put((None, None))
 
 	def receive(self):
 
-		msg = self.p.stdout.readline().decode("utf8").rstrip()		# It would end with \n otherwise
+		msg_id, msg = self.responses.get()
 
-		if not self.first_receive_time:
-			self.first_receive_time = time.monotonic()
+		if msg is None:
+			self.responses.put((None, None))	# So that any later call fails too
+			raise EOFError
 
-		if msg.startswith("="):
-			try:
-				i = msg.index(" ")
-			except:
-				i = len(msg)
-			self.last_received_msg_id = int(msg[1:i])
+		self.last_received_msg_id = msg_id
 
 		if msg.startswith("?"):
 			raise ValueError
 
 		return (self.last_received_msg_id, msg)
 
+	def command(self, msg):
+
+		# Sends msg and returns its full response as a list of lines, without the trailing blank.
+
+		self.send(msg, want_reply = True)
+		msg_id = self.last_sent_msg_id
+		ret = []
+
+		try:
+			while True:
+				incoming_msg_id, s = self.receive()
+				if incoming_msg_id != msg_id:
+					continue
+				if s == "":
+					return ret
+				ret.append(s)
+		finally:
+			self.wanted_msg_id = None
+
+	def receive_analysis(self, query_id):
+
+		# Blocks until there is an info line for the query newer than the last one returned.
+
+		with self.latest_cond:
+			while self.latest.get(query_id) is None:
+				if self.closed:
+					raise EOFError
+				self.latest_cond.wait()
+			msg = self.latest[query_id]
+			self.latest[query_id] = None
+			return msg
+
 # -------------------------------------------------------------------------------------------------
+# Daemon mode. A long-lived process holds warmed-up engines behind a Unix socket, so a short job
+# doesn't pay for the model load. Each connection leases one engine for its lifetime and talks
+# plain GTP to it; when the client goes away the engine is resynced and returned to the pool.
 
-def english(s, height):		# cc --> C17
+default_socket_path = os.path.join(tempfile.gettempdir(), "ka-daemon.sock")
+
+
+class DaemonClient(KataGo):
+
+	def __init__(self, socket_path = None, stats = False):
+
+		self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.sock.connect(socket_path or default_socket_path)
+
+		self._begin(self.sock.makefile("wb"), self.sock.makefile("rb"), stats)
+
+	def close(self):
+		self.sock.close()
+
+
+class PooledEngine():
+
+	sync_id = 999999999						# Replies with this id are the daemon's own, not the client's
+
+	def __init__(self, command = None):
+
+		self.client = None
+		self.synced = threading.Event()
+
+		self.p = subprocess.Popen(
+			command or [exe_path] + args,
+			stdin = subprocess.PIPE,
+			stdout = subprocess.PIPE,
+			stderr = subprocess.PIPE)
+
+		threading.Thread(target = relay_pipe, args = [self.p.stderr, sys.stderr], daemon = True).start()
+		threading.Thread(target = self._relay_stdout, daemon = True).start()
+
+		self.sync()							# Returns once the model is loaded
+
+	def write(self, b):
+		self.p.stdin.write(b)
+		self.p.stdin.flush()
+
+	def sync(self):
+
+		# Any command stops an analysis in progress. Once the reply to ours arrives, everything the
+		# previous client caused has been flushed, since GTP replies come in order.
+
+		self.synced.clear()
+		self.write("{} clear_board\n".format(self.sync_id).encode("utf8"))
+		self.synced.wait()
+
+	def _relay_stdout(self):
+
+		marker = "={}".format(self.sync_id).encode("utf8")
+		in_sync_reply = False
+
+		while True:
+
+			b = self.p.stdout.readline()
+
+			if not b:
+				break
+
+			if b.startswith(marker):
+				in_sync_reply = True
+				continue
+
+			if in_sync_reply:
+				if b.strip() == b"":
+					in_sync_reply = False
+					self.synced.set()
+				continue
+
+			client = self.client
+			if client:
+				try:
+					client.sendall(b)
+				except OSError:
+					pass
+
+
+class EngineDaemon():
+
+	def __init__(self, socket_path = None, count = 1, command = None):
+
+		self.socket_path = socket_path or default_socket_path
+		self.free = queue.Queue()
+
+		for n in range(count):
+			self.free.put(PooledEngine(command))
+
+	def serve_forever(self):
+
+		if os.path.exists(self.socket_path):
+			os.remove(self.socket_path)
+
+		daemon = self
+
+		class Handler(socketserver.StreamRequestHandler):
+			def handle(self):
+				daemon.handle_client(self.request, self.rfile)
+
+		self.server = socketserver.ThreadingUnixStreamServer(self.socket_path, Handler)
+		self.server.daemon_threads = True
+
+		print("Serving {} engine(s) on {}".format(self.free.qsize(), self.socket_path))
+		self.server.serve_forever()
+
+	def handle_client(self, sock, rfile):
+
+		engine = self.free.get()
+		engine.client = sock
+
+		try:
+			for line in rfile:
+				fields = line.split()
+				if fields and b"quit" in fields[:2]:			# Don't let a client kill a pooled engine
+					msg_id = fields[0] if fields[0] != b"quit" else b""
+					sock.sendall(b"=" + msg_id + b"\n\n")
+					break
+				engine.write(line)
+		except OSError:
+			pass
+		finally:
+			engine.client = None
+			engine.sync()
+			self.free.put(engine)
+
+# -------------------------------------------------------------------------------------------------
+# Parsing of kata-analyze output. One line from KataGo looks like:
+#
+#   info move D4 visits 120 utility -0.03 winrate 0.48 scoreMean -0.4 scoreStdev 12.1 scoreLead -0.4
+#   scoreSelfplay -0.5 prior 0.21 lcb 0.46 utilityLcb -0.1 order 0 pv D4 Q16 info move ... ownership ...
+#
+# All keys take a single value except the list-valued ones below, which run until the next key.
+
+class MoveInfo():
+
+	__slots__ = ("move", "visits", "winrate", "scoreLead", "prior", "lcb", "order", "pv", "pvVisits")
+
+	def __init__(self):
+		self.move = None
+		self.visits = 0
+		self.winrate = 0.0
+		self.scoreLead = 0.0
+		self.prior = 0.0
+		self.lcb = 0.0
+		self.order = 0
+		self.pv = []
+		self.pvVisits = None				# List of ints, if requested with pvVisits true
+
+	def __repr__(self):
+		return "<MoveInfo {} visits {} winrate {:.3f} scoreLead {:.2f}>".format(self.move, self.visits, self.winrate, self.scoreLead)
+
+
+class Analysis():
+
+	__slots__ = ("infos", "ownership")
+
+	def __init__(self):
+		self.infos = []
+		self.ownership = None				# Flat array("f"), row by row from the top, when requested
+
+	def total_visits(self):
+		n = 0
+		for info in self.infos:
+			n += info.visits
+		return n
+
+	def best(self):							# KataGo sends the infos sorted by order, but don't rely on it
+		ret = None
+		for info in self.infos:
+			if ret is None or info.order < ret.order:
+				ret = info
+		return ret
+
+
+class Heatmaps():
+
+	# Board-shaped float32 arrays indexed [y][x] in SGF orientation (y = 0 is the top row), which is
+	# also the order KataGo sends ownership in. They're allocated once and overwritten by each
+	# parse, so hold on to a copy if you need the values after the next one. Needs NumPy.
+	#
+	# policy holds the prior of every candidate move KataGo reported, and 0 elsewhere.
+
+	def __init__(self, width, height):
+
+		if numpy is None:
+			raise ImportError("Heatmaps need NumPy")
+
+		self.width = 0
+		self.height = 0
+		self.resize(width, height)
+
+	def resize(self, width, height):
+
+		if width == self.width and height == self.height:
+			return
+
+		self.width = width
+		self.height = height
+		self.ownership = numpy.zeros((height, width), numpy.float32)
+		self.ownership_stdev = numpy.zeros((height, width), numpy.float32)
+		self.policy = numpy.zeros((height, width), numpy.float32)
+		self.clear()
+
+	def clear(self):
+		self.has_ownership = False
+		self.has_ownership_stdev = False
+		self.policy.fill(0)
+
+	def _fill(self, target, tokens):
+		if len(tokens) != self.width * self.height:
+			raise ValueError("Got {} values for a {}x{} board".format(len(tokens), self.width, self.height))
+		target.reshape(-1)[:] = tokens		# NumPy converts the strings itself, no Python floats made
+
+	def _fill_policy(self, infos):
+		for info in infos:
+			if info.move and info.move != "pass":
+				try:
+					x, y = gofish2.english_to_xy(info.move, self.height)
+				except ValueError:
+					continue
+				if x < self.width:
+					self.policy[y][x] = info.prior
+
+
+_int_keys = {"visits", "order"}
+_float_keys = {"winrate", "scoreLead", "prior", "lcb"}
+_list_keys = {"info", "pv", "pvVisits", "pvEdgeVisits", "ownership", "ownershipStdev", "movesOwnership", "movesOwnershipStdev", "rootInfo"}
+
+
+def parse_analysis(s, want_ownership = False, heatmaps = None):
+
+	# If heatmaps is given, ownership (and ownershipStdev) go into its arrays instead of
+	# Analysis.ownership, and its policy array is filled from the priors.
+
+	tokens = s.split()
+	n = len(tokens)
+	ret = Analysis()
+	info = None
+	i = 0
+
+	if heatmaps:
+		heatmaps.clear()
+
+	while i < n:
+
+		t = tokens[i]
+
+		if t == "info":
+			info = MoveInfo()
+			ret.infos.append(info)
+			i += 1
+		elif t == "rootInfo":
+			info = None						# Its key/value pairs are skipped below
+			i += 1
+		elif t in _list_keys:
+			j = i + 1
+			while j < n and tokens[j] not in _list_keys:
+				j += 1
+			if t == "pv":
+				if info:
+					info.pv = tokens[i + 1:j]
+			elif t == "pvVisits":
+				if info:
+					info.pvVisits = [int(z) for z in tokens[i + 1:j]]
+			elif t == "ownership":
+				if heatmaps:
+					heatmaps._fill(heatmaps.ownership, tokens[i + 1:j])
+					heatmaps.has_ownership = True
+				elif want_ownership:
+					ret.ownership = array("f", map(float, tokens[i + 1:j]))
+			elif t == "ownershipStdev":
+				if heatmaps:
+					heatmaps._fill(heatmaps.ownership_stdev, tokens[i + 1:j])
+					heatmaps.has_ownership_stdev = True
+			i = j
+		elif i + 1 < n:
+			if info:
+				if t == "move":
+					info.move = tokens[i + 1]
+				elif t in _int_keys:
+					setattr(info, t, int(tokens[i + 1]))
+				elif t in _float_keys:
+					setattr(info, t, float(tokens[i + 1]))
+			i += 2
+		else:
+			break
+
+	if heatmaps:
+		heatmaps._fill_policy(ret.infos)
+
+	return ret
+
+# -------------------------------------------------------------------------------------------------
+# Stop criteria, deciding when a node has been analysed enough. The driver calls start() when it
+# sends kata-analyze and check() on every update; when check() returns True it sends "stop".
+#
+# Savings are measured against reference_visits, the fixed budget we would otherwise have used
+# (500, the old hard-coded limit). Time saved is estimated from the visit rate seen at the stop.
+# A criterion that stops after the reference budget reports negative savings, which is honest.
+
+class StopCriterion():
+
+	def __init__(self, reference_visits = 500):
+		self.reference_visits = reference_visits
+		self.start_time = None
+		self.fired = 0
+		self.visits_saved = 0
+		self.time_saved = 0.0
+
+	def start(self):
+		self.start_time = time.monotonic()
+
+	def check(self, analysis):
+
+		elapsed = time.monotonic() - self.start_time
+
+		if not self.fire(analysis, elapsed):
+			return False
+
+		visits = analysis.total_visits()
+		saved = self.reference_visits - visits
+
+		self.fired += 1
+		self.visits_saved += saved
+		if visits > 0 and elapsed > 0:
+			self.time_saved += saved * elapsed / visits
+
+		return True
+
+	def fire(self, analysis, elapsed):
+		raise NotImplementedError
+
+	def report(self):
+		return "{}: fired {} times, visits saved {}, time saved {:.2f}s".format(self, self.fired, self.visits_saved, self.time_saved)
 
-	x, y = gofish2.s_to_xy(s)
 
-	x_ascii = x + 65
-	if x_ascii >= ord("I"):
-		x_ascii += 1
+class VisitLimit(StopCriterion):
 
-	y = height - y
+	def __init__(self, visits, **kwargs):
+		super().__init__(**kwargs)
+		self.visits = visits
 
-	return chr(x_ascii) + str(y)
+	def fire(self, analysis, elapsed):
+		return analysis.total_visits() > self.visits
+
+	def __str__(self):
+		return "VisitLimit({})".format(self.visits)
+
+
+class TimeLimit(StopCriterion):
+
+	def __init__(self, seconds, **kwargs):
+		super().__init__(**kwargs)
+		self.seconds = seconds
+
+	def fire(self, analysis, elapsed):
+		return elapsed >= self.seconds
+
+	def __str__(self):
+		return "TimeLimit({})".format(self.seconds)
+
+
+class DecisiveTop(StopCriterion):
+
+	# Fires when the top move has at least `share` of the visits, or (if lcb_margin is given)
+	# when its LCB beats every other move's winrate by lcb_margin.
+
+	def __init__(self, share = 0.75, lcb_margin = None, min_visits = 50, **kwargs):
+		super().__init__(**kwargs)
+		self.share = share
+		self.lcb_margin = lcb_margin
+		self.min_visits = min_visits
+
+	def fire(self, analysis, elapsed):
+
+		total = analysis.total_visits()
+		if total < self.min_visits:
+			return False
+
+		best = analysis.best()
+
+		if best.visits >= self.share * total:
+			return True
+
+		if self.lcb_margin is not None:
+			others = [info.winrate for info in analysis.infos if info is not best]
+			if others and best.lcb - max(others) >= self.lcb_margin:
+				return True
+
+		return False
+
+	def __str__(self):
+		return "DecisiveTop({}, {})".format(self.share, self.lcb_margin)
+
+
+class StableBest(StopCriterion):
+
+	# Fires when the best move has been the same for k consecutive updates.
+
+	def __init__(self, k, min_visits = 50, **kwargs):
+		super().__init__(**kwargs)
+		self.k = k
+		self.min_visits = min_visits
+		self.last_move = None
+		self.count = 0
+
+	def start(self):
+		super().start()
+		self.last_move = None
+		self.count = 0
+
+	def fire(self, analysis, elapsed):
+
+		best = analysis.best()
+		if not best:
+			return False
+
+		if best.move == self.last_move:
+			self.count += 1
+		else:
+			self.last_move = best.move
+			self.count = 1
+
+		return self.count >= self.k and analysis.total_visits() >= self.min_visits
+
+	def __str__(self):
+		return "StableBest({})".format(self.k)
+
+
+class AnyOf(StopCriterion):
+
+	def __init__(self, *criteria, **kwargs):
+		super().__init__(**kwargs)
+		self.criteria = criteria
+
+	def start(self):
+		super().start()
+		for c in self.criteria:
+			c.start()
+
+	def fire(self, analysis, elapsed):
+		for c in self.criteria:
+			if c.check(analysis):
+				return True
+		return False
+
+	def __str__(self):
+		return "AnyOf({})".format(", ".join(str(c) for c in self.criteria))
 
 # -------------------------------------------------------------------------------------------------
+# Results sink. Each analysed node becomes one JSON line, written in batches. A node is identified
+# by its game ("filename#index") and its path, the child indices from the root, and each record
+# also carries a key for the position itself. Where each game's records are in the file is kept
+# in a dbm index beside it, so only the current game is ever held in memory (loaded by
+# begin_game), and memory stays flat however many games go through. The index notes how much of
+# the file it covers; on opening, only records beyond that (say, the last batch before a crash)
+# are read, and a file that has shrunk gets its index rebuilt. A node is skipped if its path
+# already has a result for the same position, or if the same position was analysed anywhere else
+# in that game (say, before a variation was inserted ahead of it). So a crashed job resumes from
+# its last batch, and an edited SGF only costs engine time for its new or changed positions.
+# A torn last line is ignored.
+
+def position_key(node):
+
+	board = node.make_board()
+	parts = ["".join(z or "." for z in column) for column in board.state]
+	parts.append(board.active)
+	parts.append(board.ko or "")
+	return hashlib.sha1("/".join(parts).encode("utf8")).hexdigest()[:16]
+
+
+class ResultSink():
+
+	def __init__(self, filename, batch_size = 50):
+
+		self.filename = filename
+		self.batch_size = batch_size
+		self.buffer = []
+		self.size = os.path.getsize(filename) if os.path.exists(filename) else 0
+		self.game = None
+		self.game_spans = []					# [start, end] file offsets of the current game's records
+		self.game_paths = dict()				# hash of path --> position, for the current game only
+		self.game_positions = dict()			# position --> record, for the current game only
+
+		self.index = dbm.open(filename + ".index", "c")		# game --> JSON list of spans
+
+		indexed = int(self.index.get(index_size_key, b"0"))
+
+		if indexed > self.size:				# The file was replaced or cut short
+			self.index.close()
+			self.index = dbm.open(filename + ".index", "n")
+			indexed = 0
+
+		torn = False
+
+		if indexed < self.size:
+			with open(filename, "rb") as infile:
+				infile.seek(indexed)
+				offset = indexed
+				run = None						# [game, start, end] of consecutive records
+				for line in infile:
+					start = offset
+					offset += len(line)
+					torn = not line.endswith(b"\n")
+					try:
+						game = json.loads(line)["game"]
+					except (ValueError, KeyError, TypeError):
+						continue
+					if run and run[0] == game and run[2] == start:
+						run[2] = offset
+					else:
+						if run:
+							self._store_span(*run)
+						run = [game, start, offset]
+				if run:
+					self._store_span(*run)
+		elif self.size > 0:
+			with open(filename, "rb") as infile:
+				infile.seek(self.size - 1)
+				torn = infile.read(1) != b"\n"
+
+		self.outfile = open(filename, "ab")
+
+		if torn:
+			self.outfile.write(b"\n")			# Don't glue a new record to a torn one
+			self.outfile.flush()
+			self.size += 1
+
+		self._sync_index()
+
+	def _store_span(self, game, start, end):
+		spans = self._spans(game)
+		add_span(spans, start, end)
+		self.index[game] = json.dumps(spans)
+
+	def _spans(self, game):
+		if game == self.game:
+			return self.game_spans
+		return json.loads(self.index.get(game, b"[]"))
+
+	def _sync_index(self):
+
+		# Called once the file itself is written, so the index never covers more than is there.
+
+		if self.game is not None:
+			self.index[self.game] = json.dumps(self.game_spans)
+		self.index[index_size_key] = str(self.size)
+		if hasattr(self.index, "sync"):
+			self.index.sync()
+
+	def _index(self, record):
+		self.game_paths[self.key(record["path"])] = record.get("position")
+		if record.get("position"):
+			self.game_positions[record["position"]] = record
+
+	def records(self, game = None):
+
+		# Reads back what's on disk (not what's still buffered), optionally for one game only.
+
+		with open(self.filename, "rb") as infile:
+
+			if game is None:
+				for line in infile:
+					try:
+						yield json.loads(line)
+					except ValueError:
+						continue
+				return
+
+			for start, end in self._spans(game):
+				infile.seek(start)
+				while infile.tell() < end:
+					line = infile.readline()
+					if not line:
+						break
+					try:
+						record = json.loads(line)
+					except ValueError:
+						continue
+					if record.get("game") == game:
+						yield record
+
+	def key(self, path):
+
+		# Paths are compared by hash, which keeps the index small for deep games. A collision can
+		# only make done() trust a result for the very same position, so it costs nothing.
+
+		return hash(tuple(path))
+
+	def begin_game(self, game):
+
+		self.flush()
+		self.game = game
+		self.game_spans = json.loads(self.index.get(game, b"[]"))
+		self.game_paths = dict()
+		self.game_positions = dict()
+
+		for record in self.records(game):
+			self._index(record)
+
+	def done(self, game, path, position = None):
+
+		# True if there's already a result for this node. A result found under another path is
+		# copied to this one, so that the file alone describes the current tree. Only the game
+		# passed to begin_game is indexed.
+
+		if game != self.game:
+			return False
+
+		key = self.key(path)
+
+		if key in self.game_paths:
+			stored = self.game_paths[key]
+			if stored is None or position is None or stored == position:
+				return True
+
+		if position in self.game_positions:
+			record = dict(self.game_positions[position])
+			record["path"] = path
+			self._append(record)
+			return True
+
+		return False
+
+	def write(self, game, path, node, analysis, heatmaps = None):
+
+		best = analysis.best()
+
+		record = {
+			"game": game,
+			"path": path,
+			"position": position_key(node),
+			"black_to_move": node.make_board().active == "b",
+			"visits": analysis.total_visits(),
+			"winrate": best.winrate,
+			"scoreLead": best.scoreLead,
+			"best": best.move,
+			"pv": best.pv,
+			"moves": [[info.move, info.visits, info.winrate, info.scoreLead, info.prior, info.lcb] for info in analysis.infos],
+		}
+
+		if heatmaps and heatmaps.has_ownership:
+			record["ownership"] = [round(z, 4) for z in heatmaps.ownership.reshape(-1).tolist()]
+
+		self._append(record)
+
+	def _append(self, record):
+
+		b = (json.dumps(record) + "\n").encode("utf8")
+		start = self.size
+		self.size += len(b)
+		self.buffer.append(b)
+
+		if record["game"] == self.game:
+			add_span(self.game_spans, start, self.size)
+			self._index(record)
+		else:
+			self._store_span(record["game"], start, self.size)
+			self.flush()
 
-if len(sys.argv) < 2:
-	print("Usage: {} <filename>".format(sys.argv[0]))
-	sys.exit()
+		if len(self.buffer) >= self.batch_size:
+			self.flush()
 
-katago = KataGo()
+	def flush(self):
+		if self.buffer:
+			self.outfile.write(b"".join(self.buffer))
+			self.buffer = []
+			self.outfile.flush()
+			self._sync_index()
 
-node = gofish2.load(sys.argv[1])[0]
-depth = 0
+	def close(self):
+		self.flush()
+		self.outfile.close()
+		self.index.close()
 
-if node.width != node.height:
-	raise ValueError
 
-size = node.width
-komi = float(node.get("KM")) if node.get("KM") else 0
+index_size_key = "\0size"						# Bytes of the file the index covers; no game name has a NUL
 
-katago.send(f"boardsize {size}")
-katago.send(f"clear_board")
-katago.send(f"komi {komi}")
+def add_span(spans, start, end):
 
-while True:
+	# A game's records are nearly always written together, so consecutive ones just extend its
+	# last span.
 
-	ab = node.all_values("AB")
-	aw = node.all_values("AW")
-	b = node.all_values("B")
-	w = node.all_values("W")
+	if spans and spans[-1][1] == start:
+		spans[-1][1] = end
+	else:
+		spans.append([start, end])
 
-	for item in ab:
-		katago.send(f"play b {english(item, size)}")
-	for item in aw:
-		katago.send(f"play w {english(item, size)}")
-	for item in b:
-		katago.send(f"play b {english(item, size)}")
-	for item in w:
-		katago.send(f"play w {english(item, size)}")
 
-	katago.send("kata-analyze interval 10")
+def annotate(root, records):
+
+	# Writes the results into the tree as properties: SBKV (Black's winrate in percent, as used by
+	# Sabaki), KASL (Black's score lead) and KABM (the best move, in SGF coordinates).
+	# KataGo's default reports from the side to move's point of view, so flip for White.
+	# Records whose path now leads to a different position (the file was edited) are skipped.
+
+	for record in records:
+
+		node = root
+		try:
+			for i in record["path"]:
+				node = node.children[i]
+		except IndexError:
+			continue
+
+		if record.get("position") and record["position"] != position_key(node):
+			continue
+
+		winrate = record["winrate"]
+		score = record["scoreLead"]
+		if not record["black_to_move"]:
+			winrate = 1 - winrate
+			score = -score
+
+		node.set("SBKV", "{:.2f}".format(winrate * 100))
+		node.set("KASL", "{:.1f}".format(score))
+
+		best = record["best"]
+		if best and best != "pass":
+			try:
+				x, y = gofish2.english_to_xy(best, node.height)
+				node.set("KABM", gofish2.xy_to_s(x, y))
+			except ValueError:
+				pass
+
+# -------------------------------------------------------------------------------------------------
+
+def english(s, height):		# cc --> C17
+
+	return gofish2.sgf_to_gtp(s, height)
+
+def gtp_moves(node, size):
+
+	# The GTP moves needed to get from the parent's position to this node's; setup stones are
+	# sent as moves too, so each item here costs exactly one "undo" to take back.
+
+	ret = []
+	for key, colour in [("AB", "b"), ("AW", "w"), ("B", "b"), ("W", "w")]:
+		for s in node.all_values(key):
+			if node.validated_move_string(s):
+				ret.append((colour, english(s, size)))
+			else:
+				ret.append((colour, "pass"))
+	return ret
+
+
+def analyse_current(katago, stopper, heatmaps = None):
+
+	if heatmaps:
+		katago.send("kata-analyze interval 10 ownership true ownershipStdev true pvVisits true")
+	else:
+		katago.send("kata-analyze interval 10")
+
+	query_id = katago.last_sent_msg_id
+	stopper.start()
 
 	while True:
 
-		incoming_msg_id, s = katago.receive()
+		analysis = parse_analysis(katago.receive_analysis(query_id), heatmaps = heatmaps)
+
+		if analysis.infos and stopper.check(analysis):
+			katago.send("stop")
+			if katago.stats:
+				katago.stats.analysis_done(query_id, analysis.total_visits())
+			return analysis
+
+
+def walk_tree(katago, stopper, root, size, max_depth = None, max_branches = None, verbose = True, heatmaps = None,
+		sink = None, game = ""):
+
+	# Depth-first, so a shared prefix is played once and we back out of a branch with "undo".
+	# Undos are sent lazily so that the engine is left at the last node analysed.
+	# With max_branches = 1 this is just the main line. Returns the number of nodes analysed.
+	# Nodes the sink already has are played through but not analysed.
+
+	stack = [(root, [])]
+	pending_undo = 0
+	count = 0
+
+	while stack:
+
+		node, path = stack.pop()
+
+		if node is None:					# Marker: we're leaving a node, so take back its moves
+			pending_undo += path
+			continue
+
+		depth = len(path)
+
+		for n in range(pending_undo):
+			katago.send("undo")
+		pending_undo = 0
+
+		moves = gtp_moves(node, size)
+		for colour, vertex in moves:
+			katago.send(f"play {colour} {vertex}")
+
+		if not sink or not sink.done(game, path, position_key(node)):
+			analysis = analyse_current(katago, stopper, heatmaps)
+			if sink:
+				sink.write(game, path, node, analysis, heatmaps)
+			if verbose:
+				best = analysis.best()
+				extra = ""
+				if heatmaps and heatmaps.has_ownership:
+					extra = ", ownership sum {:+.1f}".format(float(heatmaps.ownership.sum()))
+				print(f"Node {count} (depth {depth}): total visits {analysis.total_visits()}, best move: {best.move} ({best.visits}){extra}")
+			count += 1
 
-		if incoming_msg_id != katago.last_sent_msg_id:
+		stack.append((None, len(moves)))
+
+		if max_depth is not None and depth >= max_depth:
 			continue
 
-		moveinfos = s.split("info")
+		children = node.children if max_branches is None else node.children[:max_branches]
+		for i in range(len(children) - 1, -1, -1):
+			stack.append((children[i], path + [i]))
 
-		totalvisits = 0
-		topmove = None
-		topvisits = 0
+	return count
 
-		for moveinfo in moveinfos:
+def analyse_file(filename, katago, stopper, opts, sink = None, heatmaps = None):
 
-			tokens = moveinfo.split(" ")
+	count = 0
 
-			if "visits" in tokens:
-				totalvisits += int(tokens[tokens.index("visits") + 1])
+	for index, root in enumerate(gofish2.load(filename)):
 
-			if not topmove and "move" in tokens:
-				topmove = tokens[tokens.index("move") + 1]
-				if "visits" in tokens:
-					topvisits = int(tokens[tokens.index("visits") + 1])
+		if root.width != root.height:
+			raise ValueError("{}x{} board; only square boards can be analysed".format(root.width, root.height))
 
-		if totalvisits > 500:
-			print(f"Node {depth}: total visits {totalvisits}, best move: {topmove} ({topvisits})")
-			break
+		game = "{}#{}".format(filename, index)
+		size = root.width
+		komi = float(root.get("KM")) if root.get("KM") else 0
+
+		katago.send(f"boardsize {size}")
+		katago.send(f"clear_board")
+		katago.send(f"komi {komi}")
+
+		if heatmaps:
+			heatmaps.resize(size, size)
+
+		if sink:
+			sink.begin_game(game)
+
+		if opts.tree:
+			count += walk_tree(katago, stopper, root, size, opts.max_depth, opts.max_branches,
+				heatmaps = heatmaps, sink = sink, game = game)
+		else:
+			count += walk_tree(katago, stopper, root, size, max_branches = 1,
+				heatmaps = heatmaps, sink = sink, game = game)
+
+		if sink:
+			sink.flush()
+			if opts.annotate:
+				annotate(root, sink.records(game))
+				outname = "{}_{}.sgf".format(os.path.splitext(os.path.basename(filename))[0], index)
+				gofish2.save(os.path.join(opts.annotate, outname), root)
+
+	return count
+
+
+def watch_folder(folder, katago, stopper, opts, sink, heatmaps, poll = 2.0):
+
+	# Never returns. Any game file that appears or changes is (re)analysed; with the sink's
+	# position matching, only its new or changed positions reach the engine.
+
+	seen = dict()							# filename --> mtime when last analysed
+
+	while True:
+
+		for name in sorted(os.listdir(folder)):
+
+			if not name.lower().endswith((".sgf", ".gib", ".ngf")):
+				continue
+
+			filename = os.path.join(folder, name)
+
+			try:
+				mtime = os.path.getmtime(filename)
+			except OSError:
+				continue
+
+			if seen.get(filename) == mtime:
+				continue
+
+			seen[filename] = mtime
+
+			# A bad file (unparseable, non-square, or gone or unreadable by the time it's loaded)
+			# is reported and skipped, and will be retried if it changes again.
+
+			try:
+				count = analyse_file(filename, katago, stopper, opts, sink, heatmaps)
+			except (gofish2.ParserFail, ValueError, OSError) as err:
+				print("{}: {}".format(filename, err))
+				continue
+
+			print("{}: {} positions analysed".format(filename, count))
+
+		time.sleep(poll)
+
+# -------------------------------------------------------------------------------------------------
+
+def main():
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("filenames", nargs = "*")
+	parser.add_argument("--visits", type = int, default = 500, help = "stop a node after this many visits")
+	parser.add_argument("--time", type = float, help = "stop a node after this many seconds")
+	parser.add_argument("--decisive", type = float, help = "stop when the top move has this share of visits")
+	parser.add_argument("--lcb-margin", type = float, help = "stop when the top move's LCB leads all others by this")
+	parser.add_argument("--stable", type = int, help = "stop when the best move is unchanged for this many updates")
+	parser.add_argument("--tree", action = "store_true", help = "analyse every node, not just the main line")
+	parser.add_argument("--max-depth", type = int, help = "with --tree, don't go deeper than this")
+	parser.add_argument("--max-branches", type = int, help = "with --tree, follow at most this many children per node")
+	parser.add_argument("--daemon", action = "store_true", help = "hold warmed-up engines behind a Unix socket")
+	parser.add_argument("--engines", type = int, default = 1, help = "with --daemon, how many engines to hold")
+	parser.add_argument("--connect", action = "store_true", help = "use an engine from a running daemon")
+	parser.add_argument("--socket", help = "socket path for --daemon / --connect")
+	parser.add_argument("--engine-command", help = "command line to run instead of the configured KataGo")
+	parser.add_argument("--ownership", action = "store_true", help = "request ownership and pvVisits, decoded into NumPy heatmaps")
+	parser.add_argument("--stats", action = "store_true", help = "instrument the engine client and print metrics at the end")
+	parser.add_argument("--jsonl", help = "append results here, one line per node, and resume from what's there")
+	parser.add_argument("--annotate", help = "with --jsonl, write annotated SGF files into this directory")
+	parser.add_argument("--watch", help = "with --jsonl, keep analysing new and edited files in this directory")
+	opts = parser.parse_args()
+
+	command = shlex.split(opts.engine_command) if opts.engine_command else None
+
+	if opts.daemon:
+		EngineDaemon(opts.socket, opts.engines, command).serve_forever()
+		return
+
+	if not opts.filenames and not opts.watch:
+		parser.error("a filename is required unless --daemon or --watch is given")
+
+	if (opts.annotate or opts.watch) and not opts.jsonl:
+		parser.error("--annotate and --watch need --jsonl")
+
+	criteria = [VisitLimit(opts.visits)]
+	if opts.time is not None:
+		criteria.append(TimeLimit(opts.time))
+	if opts.decisive is not None or opts.lcb_margin is not None:
+		criteria.append(DecisiveTop(opts.decisive if opts.decisive is not None else 1.01, opts.lcb_margin))
+	if opts.stable is not None:
+		criteria.append(StableBest(opts.stable))
+	stopper = AnyOf(*criteria)
+
+	if opts.connect:
+		katago = DaemonClient(opts.socket, opts.stats)
+	else:
+		katago = KataGo(command, opts.stats)
+
+	sink = ResultSink(opts.jsonl) if opts.jsonl else None
+	heatmaps = Heatmaps(19, 19) if opts.ownership else None
+	count = 0
+
+	start_time = time.monotonic()
+
+	if opts.watch:
+		watch_folder(opts.watch, katago, stopper, opts, sink, heatmaps)
+
+	for filename in opts.filenames:
+		count += analyse_file(filename, katago, stopper, opts, sink, heatmaps)
+
+	if sink:
+		sink.close()
+
+	elapsed = time.monotonic() - start_time
+
+	boardtext = "\n".join(katago.command("showboard"))
+
+	print(boardtext)
 
-	if len(node.children) == 0:
-		break
+	print("Time elapsed:")
+	print(time.monotonic() - katago.first_receive_time)
 
-	node = node.children[0]
-	depth += 1
+	print("Nodes analysed: {} ({:.2f} per second)".format(count, count / elapsed if elapsed > 0 else 0))
 
-katago.send("showboard")
-boardtext = ""
+	print(stopper.report())
+	for c in stopper.criteria:
+		print(c.report())
 
-while True:
-	incoming_msg_id, s = katago.receive()
-	if incoming_msg_id != katago.last_sent_msg_id:
-		continue
-	if s == "":
-		break
-	boardtext += s + "\n"
+	if katago.stats:
+		print(katago.stats.prometheus(), end = "")
 
-print(boardtext)
 
-print("Time elapsed:")
-print(time.monotonic() - katago.first_receive_time)
+if __name__ == "__main__":
+	main()
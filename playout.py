@@ -0,0 +1,508 @@
+#!/usr/bin/env python3
+
+import argparse, gofish2, json, multiprocessing, os, platform, random, time
+
+# Monte-Carlo playouts: random moves until both sides pass, then area scoring. The board is a flat
+# list with a border, indexed by integers, and each string keeps a circular list of its stones
+# plus pseudo-liberty count, sum and sum of squares, so captures and atari are found without any
+# flood fills. Every playout's RNG is seeded from (seed, playout number), so results are the same
+# however many processes run them. Run as a script, this is a benchmark reporting playouts per
+# second per core, and with --verify it replays playouts on gofish2.Board to check the rules.
+
+EMPTY, BLACK, WHITE, BORDER = 0, 1, 2, 3
+
+# -------------------------------------------------------------------------------------------------
+
+class PlayoutBoard():
+
+	def __init__(self, width, height):
+
+		self.width = width
+		self.height = height
+		self.stride = stride = width + 1		# One border column serves both sides
+		n = (height + 2) * stride + 1
+
+		self.colour = [BORDER] * n
+		self.head = [0] * n					# Any stone --> its string's head
+		self.link = [0] * n					# Next stone in the string, circularly
+		self.size = [0] * n					# These four are only valid at heads
+		self.libs = [0] * n
+		self.lib_sum = [0] * n
+		self.lib_sum2 = [0] * n
+
+		self.empty = []						# Empty points, in no particular order
+		self.empty_index = [-1] * n
+
+		for y in range(height):
+			for x in range(width):
+				p = (y + 1) * stride + x + 1
+				self.colour[p] = EMPTY
+				self.empty_index[p] = len(self.empty)
+				self.empty.append(p)
+
+		self.ko = 0
+		self.active = BLACK
+		self.caps = [0, 0, 0]				# Indexed by the capturing colour
+
+
+	@classmethod
+	def from_board(cls, board):
+
+		ret = cls(board.width, board.height)
+
+		for x in range(board.width):
+			for y in range(board.height):
+				c = board.state[x][y]
+				if c:
+					ret._add_stone(ret.point(x, y), BLACK if c == "b" else WHITE)
+
+		if board.ko:
+			x, y = gofish2.s_to_xy(board.ko)
+			ret.ko = ret.point(x, y)
+
+		ret.active = BLACK if board.active == "b" else WHITE
+		ret.caps = [0, board.caps_by_b, board.caps_by_w]
+		return ret
+
+
+	def to_board(self):
+
+		ret = gofish2.Board(self.width, self.height)
+
+		for x in range(self.width):
+			for y in range(self.height):
+				c = self.colour[self.point(x, y)]
+				if c != EMPTY:
+					ret.state[x][y] = "b" if c == BLACK else "w"
+
+		if self.ko:
+			ret.ko = gofish2.xy_to_s(*self.xy(self.ko))
+
+		ret.active = "b" if self.active == BLACK else "w"
+		ret.caps_by_b = self.caps[BLACK]
+		ret.caps_by_w = self.caps[WHITE]
+		return ret
+
+
+	def copy(self):
+
+		ret = PlayoutBoard.__new__(PlayoutBoard)
+		ret.__dict__.update(self.__dict__)
+
+		for attr in ["colour", "head", "link", "size", "libs", "lib_sum", "lib_sum2", "empty", "empty_index", "caps"]:
+			setattr(ret, attr, getattr(self, attr)[:])
+
+		return ret
+
+
+	def point(self, x, y):
+		return (y + 1) * self.stride + x + 1
+
+
+	def xy(self, p):
+		return p % self.stride - 1, p // self.stride - 1
+
+
+	def in_atari(self, h):					# True if the string with head h has exactly one liberty
+		libs = self.libs[h]
+		return libs > 0 and libs * self.lib_sum2[h] == self.lib_sum[h] * self.lib_sum[h]
+
+
+	def legal(self, p, c):					# Suicide is not allowed
+
+		colour = self.colour
+		if colour[p] != EMPTY or p == self.ko:
+			return False
+
+		stride = self.stride
+		neighbours = (p - 1, p + 1, p - stride, p + stride)
+
+		for n in neighbours:
+			if colour[n] == EMPTY:
+				return True
+
+		for n in neighbours:
+			nc = colour[n]
+			if nc == c:
+				if not self.in_atari(self.head[n]):
+					return True
+			elif nc != BORDER:
+				if self.in_atari(self.head[n]):
+					return True
+
+		return False
+
+
+	def is_eye(self, p, c):					# A simple eye of c's, which a playout shouldn't fill
+
+		colour = self.colour
+		stride = self.stride
+
+		for n in (p - 1, p + 1, p - stride, p + stride):
+			if colour[n] != c and colour[n] != BORDER:
+				return False
+
+		bad = 0
+		edge = False
+		for n in (p - stride - 1, p - stride + 1, p + stride - 1, p + stride + 1):
+			if colour[n] == BORDER:
+				edge = True
+			elif colour[n] != c and colour[n] != EMPTY:
+				bad += 1
+
+		return bad == 0 if edge else bad <= 1
+
+
+	def play(self, p, c):					# p must be legal for c
+
+		opp = BLACK + WHITE - c
+		colour = self.colour
+		head = self.head
+		stride = self.stride
+
+		self._add_stone(p, c)
+
+		captured = 0
+		last = 0
+
+		for n in (p - 1, p + 1, p - stride, p + stride):
+			if colour[n] == opp and self.libs[head[n]] == 0:
+				captured += self.size[head[n]]
+				last = n
+				self._remove_string(head[n])
+
+		self.caps[c] += captured
+
+		h = head[p]
+		if captured == 1 and self.size[h] == 1 and self.libs[h] == 1:
+			self.ko = last
+		else:
+			self.ko = 0
+
+		self.active = opp
+
+
+	def play_pass(self):
+
+		self.ko = 0
+		self.active = BLACK + WHITE - self.active
+
+
+	def _add_stone(self, p, c):
+
+		colour = self.colour
+		head = self.head
+		libs = self.libs
+		lib_sum = self.lib_sum
+		lib_sum2 = self.lib_sum2
+		stride = self.stride
+
+		colour[p] = c
+		head[p] = p
+		self.link[p] = p
+		self.size[p] = 1
+		libs[p] = 0
+		lib_sum[p] = 0
+		lib_sum2[p] = 0
+
+		i = self.empty_index[p]				# Remove p from the empty list
+		last = self.empty.pop()
+		if last != p:
+			self.empty[i] = last
+			self.empty_index[last] = i
+		self.empty_index[p] = -1
+
+		neighbours = (p - 1, p + 1, p - stride, p + stride)
+
+		for n in neighbours:
+			nc = colour[n]
+			if nc == EMPTY:
+				libs[p] += 1
+				lib_sum[p] += n
+				lib_sum2[p] += n * n
+			elif nc != BORDER:
+				h = head[n]
+				libs[h] -= 1
+				lib_sum[h] -= p
+				lib_sum2[h] -= p * p
+
+		for n in neighbours:
+			if colour[n] == c and head[n] != head[p]:
+				self._merge(head[p], head[n])
+
+
+	def _merge(self, a, b):
+
+		head = self.head
+		link = self.link
+
+		if self.size[a] < self.size[b]:
+			a, b = b, a						# The smaller string, b, is relabelled
+
+		s = b
+		while True:
+			head[s] = a
+			s = link[s]
+			if s == b:
+				break
+
+		link[a], link[b] = link[b], link[a]
+
+		self.size[a] += self.size[b]
+		self.libs[a] += self.libs[b]
+		self.lib_sum[a] += self.lib_sum[b]
+		self.lib_sum2[a] += self.lib_sum2[b]
+
+
+	def _remove_string(self, h):
+
+		colour = self.colour
+		head = self.head
+		link = self.link
+		stride = self.stride
+		c = colour[h]
+		opp = BLACK + WHITE - c
+
+		s = h
+		while True:
+			colour[s] = EMPTY
+			self.empty_index[s] = len(self.empty)
+			self.empty.append(s)
+			for n in (s - 1, s + 1, s - stride, s + stride):
+				if colour[n] == opp:
+					nh = head[n]
+					self.libs[nh] += 1
+					self.lib_sum[nh] += s
+					self.lib_sum2[nh] += s * s
+			s = link[s]
+			if s == h:
+				break
+
+
+	def score(self, komi = 0):				# Area score, Black minus White minus komi
+
+		colour = self.colour
+		stride = self.stride
+		seen = set()
+		counts = [0, 0, 0, 0]
+
+		for y in range(self.height):
+			for x in range(self.width):
+
+				p = (y + 1) * stride + x + 1
+				c = colour[p]
+
+				if c != EMPTY:
+					counts[c] += 1
+					continue
+				if p in seen:
+					continue
+
+				seen.add(p)
+				stack = [p]
+				region = 0
+				touches = 0					# Bit 1 for Black, bit 2 for White
+
+				while stack:
+					q = stack.pop()
+					region += 1
+					for n in (q - 1, q + 1, q - stride, q + stride):
+						nc = colour[n]
+						if nc == EMPTY:
+							if n not in seen:
+								seen.add(n)
+								stack.append(n)
+						elif nc != BORDER:
+							touches |= nc
+
+				if touches == BLACK or touches == WHITE:
+					counts[touches] += region
+
+		return counts[BLACK] - counts[WHITE] - komi
+
+# -------------------------------------------------------------------------------------------------
+
+def playout(board, rng, eye_avoid = True, max_moves = None, on_move = None):
+
+	# Plays random legal moves on board (which is changed) until two passes in a row. Returns
+	# the number of moves, passes included. on_move, if given, is called with each (point, colour),
+	# the point being 0 for a pass.
+
+	if max_moves is None:
+		max_moves = 3 * board.width * board.height
+
+	empty = board.empty
+	index = board.empty_index
+	random_ = rng.random
+	passes = 0
+	moves = 0
+
+	while passes < 2 and moves < max_moves:
+
+		c = board.active
+		n = len(empty)
+		chosen = 0
+
+		while n > 0:
+			i = int(random_() * n)
+			p = empty[i]
+			if board.legal(p, c) and not (eye_avoid and board.is_eye(p, c)):
+				chosen = p
+				break
+			n -= 1							# Move the rejected point out of the way
+			q = empty[n]
+			empty[i], empty[n] = q, p
+			index[q], index[p] = i, n
+
+		if chosen:
+			board.play(chosen, c)
+			passes = 0
+		else:
+			board.play_pass()
+			passes += 1
+
+		moves += 1
+
+		if on_move:
+			on_move(chosen, c)
+
+	return moves
+
+
+def playout_rng(seed, number):
+	return random.Random("{}:{}".format(seed, number))
+
+
+def run_playouts(board, first, count, seed, komi = 0, eye_avoid = True):
+
+	# Playouts number first to first + count - 1 from the given PlayoutBoard or gofish2.Board.
+	# Returns a list of (score, moves).
+
+	if isinstance(board, gofish2.Board):
+		board = PlayoutBoard.from_board(board)
+
+	ret = []
+
+	for number in range(first, first + count):
+		b = board.copy()
+		moves = playout(b, playout_rng(seed, number), eye_avoid)
+		ret.append((b.score(komi), moves))
+
+	return ret
+
+
+def _run_chunk(args):
+	return run_playouts(*args)
+
+
+def run_pool(board, count, seed, komi = 0, eye_avoid = True, processes = None, chunk = 64):
+
+	# As run_playouts() for playouts 0 to count - 1, split into chunks across a process pool. The
+	# board is sent as a gofish2.Board.
+
+	if isinstance(board, PlayoutBoard):
+		board = board.to_board()
+
+	jobs = [(board, first, min(chunk, count - first), seed, komi, eye_avoid) for first in range(0, count, chunk)]
+
+	with multiprocessing.Pool(processes) as pool:
+		results = pool.map(_run_chunk, jobs)
+
+	return [item for result in results for item in result]
+
+
+def verify(board, seed, count, eye_avoid = True):
+
+	# Replays playouts on gofish2.Board alongside, comparing the positions after every move.
+	# Returns the number of moves checked; raises ValueError at the first difference.
+
+	checked = 0
+
+	for number in range(count):
+
+		pboard = PlayoutBoard.from_board(board)
+		gboard = board.copy()
+
+		def on_move(p, c):
+			nonlocal checked
+			if p:
+				x, y = pboard.xy(p)
+			else:
+				x, y = -1, -1
+			gboard.play_xy(x, y, "b" if c == BLACK else "w")
+			if pboard.to_board() != gboard:
+				raise ValueError("Playout {} differs from gofish2.Board after {} moves".format(number, checked))
+			checked += 1
+
+		playout(pboard, playout_rng(seed, number), eye_avoid, on_move = on_move)
+
+		if pboard.score() != gboard.score():
+			raise ValueError("Playout {} scores differently".format(number))
+
+	return checked
+
+# -------------------------------------------------------------------------------------------------
+
+def main():
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--size", type = int, default = 9)
+	parser.add_argument("--sgf", help = "start from the end of this file's main line instead of an empty board")
+	parser.add_argument("--komi", type = float, default = 7.0)
+	parser.add_argument("--playouts", type = int, default = 2000)
+	parser.add_argument("--processes", type = int, default = os.cpu_count() or 1)
+	parser.add_argument("--seed", type = int, default = 1)
+	parser.add_argument("--uniform", action = "store_true", help = "allow filling own eyes")
+	parser.add_argument("--verify", type = int, default = 0, help = "first check this many playouts against gofish2.Board")
+	parser.add_argument("--output", help = "write JSON here instead of stdout")
+	opts = parser.parse_args()
+
+	if opts.sgf:
+		board = gofish2.load(opts.sgf)[0].get_end().make_board()
+	else:
+		board = gofish2.Board(opts.size, opts.size)
+
+	eye_avoid = not opts.uniform
+	report = {}
+
+	if opts.verify:
+		t = time.perf_counter()
+		report["verify"] = {"playouts": opts.verify, "moves": verify(board, opts.seed, opts.verify, eye_avoid),
+			"seconds": time.perf_counter() - t}
+
+	t = time.perf_counter()
+	single = run_playouts(board, 0, max(1, opts.playouts // 10), opts.seed, opts.komi, eye_avoid)
+	single_seconds = time.perf_counter() - t
+
+	t = time.perf_counter()
+	results = run_pool(board, opts.playouts, opts.seed, opts.komi, eye_avoid, opts.processes)
+	seconds = time.perf_counter() - t
+
+	scores = [score for score, moves in results]
+
+	report.update({
+		"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"params": {"width": board.width, "height": board.height, "komi": opts.komi, "playouts": opts.playouts,
+			"processes": opts.processes, "seed": opts.seed, "eye_avoid": eye_avoid},
+		"single_process": {"playouts": len(single), "seconds": single_seconds,
+			"playouts_per_second": len(single) / single_seconds if single_seconds > 0 else 0},
+		"pool": {"seconds": seconds, "playouts_per_second": len(results) / seconds if seconds > 0 else 0,
+			"playouts_per_second_per_core": len(results) / seconds / opts.processes if seconds > 0 else 0},
+		"mean_score": sum(scores) / len(scores) if scores else 0,
+		"black_wins": sum(1 for score in scores if score > 0) / len(scores) if scores else 0,
+		"mean_moves": sum(moves for score, moves in results) / len(results) if results else 0,
+	})
+
+	s = json.dumps(report, indent = 1)
+
+	if opts.output:
+		with open(opts.output, "w", encoding = "utf8") as outfile:
+			outfile.write(s + "\n")
+	else:
+		print(s)
+
+
+if __name__ == "__main__":
+	main()
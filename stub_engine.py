@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+import argparse, sys, threading, time
+
+# A stand-in for KataGo that speaks enough GTP for ka.py and the benchmarks, with no model to load.
+# Replies can be delayed by --latency, and kata-analyze output is produced at the requested
+# interval (or --interval to override it). With --replay, info lines are taken in turn from a
+# recorded transcript of KataGo's stdout instead of being made up.
+
+# -------------------------------------------------------------------------------------------------
+
+class StubEngine():
+
+	def __init__(self, opts):
+
+		self.opts = opts
+		self.size = 19
+		self.moves = []
+		self.out_lock = threading.Lock()
+		self.analysis = None					# [stop_flag, thread] while analysing
+
+		self.replay_lines = []
+		self.replay_index = 0
+
+		if opts.replay:
+			with open(opts.replay, encoding = "utf8") as infile:
+				self.replay_lines = [line.strip() for line in infile if line.startswith("info")]
+
+	def out(self, s):
+		with self.out_lock:
+			sys.stdout.write(s)
+			sys.stdout.flush()
+
+	def reply(self, msg_id, s = ""):
+		if s:
+			self.out("={} {}\n\n".format(msg_id, s))
+		else:
+			self.out("={}\n\n".format(msg_id))
+
+	def error(self, msg_id, s):
+		self.out("?{} {}\n\n".format(msg_id, s))
+
+	def stop_analysis(self):
+		if self.analysis:
+			self.analysis[0] = True
+			self.analysis[1].join()
+			self.analysis = None
+
+	def run(self):
+
+		for line in sys.stdin:
+
+			fields = line.split()
+			if not fields:
+				continue
+
+			if fields[0].isdigit():
+				msg_id = fields[0]
+				fields = fields[1:]
+			else:
+				msg_id = ""
+
+			if not fields:
+				continue
+
+			self.stop_analysis()				# Any command stops analysis, as with KataGo
+
+			if self.opts.latency > 0:
+				time.sleep(self.opts.latency)
+
+			cmd, cmd_args = fields[0], fields[1:]
+
+			if cmd == "quit":
+				self.reply(msg_id)
+				return
+			elif cmd == "kata-analyze":
+				self.start_analysis(msg_id, cmd_args)
+			else:
+				self.handle(msg_id, cmd, cmd_args)
+
+	def handle(self, msg_id, cmd, cmd_args):
+
+		if cmd == "protocol_version":
+			self.reply(msg_id, "2")
+		elif cmd == "name":
+			self.reply(msg_id, "StubEngine")
+		elif cmd == "version":
+			self.reply(msg_id, "0")
+		elif cmd == "boardsize":
+			try:
+				self.size = int(cmd_args[0])
+			except:
+				self.error(msg_id, "unacceptable size")
+				return
+			self.moves = []
+			self.reply(msg_id)
+		elif cmd == "clear_board":
+			self.moves = []
+			self.reply(msg_id)
+		elif cmd == "komi" or cmd == "stop":
+			self.reply(msg_id)
+		elif cmd == "play":
+			if len(cmd_args) < 2:
+				self.error(msg_id, "syntax error")
+				return
+			self.moves.append((cmd_args[0], cmd_args[1]))
+			self.reply(msg_id)
+		elif cmd == "undo":
+			if not self.moves:
+				self.error(msg_id, "cannot undo")
+				return
+			self.moves.pop()
+			self.reply(msg_id)
+		elif cmd == "showboard":
+			self.out("={}\nStub board {}x{}, {} moves played\n\n".format(msg_id, self.size, self.size, len(self.moves)))
+		elif cmd == "list_commands":
+			self.reply(msg_id, "\n".join(["boardsize", "clear_board", "kata-analyze", "komi", "name", "play",
+				"protocol_version", "quit", "showboard", "stop", "undo", "version"]))
+		else:
+			self.error(msg_id, "unknown command")
+
+	def start_analysis(self, msg_id, cmd_args):
+
+		interval = 1.0
+		flags = set()							# Which of ownership, ownershipStdev, pvVisits are on
+
+		# kata-analyze [colour] [interval] <cs> [key value ...]
+
+		i = 0
+		while i < len(cmd_args):
+			if cmd_args[i] == "interval" and i + 1 < len(cmd_args):
+				interval = float(cmd_args[i + 1]) / 100
+				i += 2
+			elif cmd_args[i] in ["ownership", "ownershipStdev", "pvVisits"] and i + 1 < len(cmd_args):
+				if cmd_args[i + 1] == "true":
+					flags.add(cmd_args[i])
+				i += 2
+			elif cmd_args[i].isdigit():
+				interval = float(cmd_args[i]) / 100
+				i += 1
+			else:
+				i += 1
+
+		if self.opts.interval is not None:
+			interval = self.opts.interval
+
+		self.out("={}\n".format(msg_id))
+
+		flag = [False, None]
+		flag[1] = threading.Thread(target = self.analyse, args = [flag, interval, flags], daemon = True)
+		self.analysis = flag
+		flag[1].start()
+
+	def analyse(self, flag, interval, flags):
+
+		visits = 0
+		next_time = time.monotonic() + interval
+
+		while True:
+
+			delay = next_time - time.monotonic()
+			if delay > 0:
+				time.sleep(delay)
+			next_time += interval
+
+			if flag[0]:
+				break
+
+			visits += self.opts.visits_per_line
+			self.out(self.info_line(visits, flags) + "\n")
+
+		self.out("\n")
+
+	def info_line(self, visits, flags):
+
+		if self.replay_lines:
+			s = self.replay_lines[self.replay_index % len(self.replay_lines)]
+			self.replay_index += 1
+			return s
+
+		parts = []
+		remaining = visits
+		letters = "ABCDEFGHJKLMNOPQRSTUVWXYZ"
+
+		for n in range(self.opts.candidates):
+			v = remaining // 2 if n < self.opts.candidates - 1 else remaining
+			remaining -= v
+			move = letters[(3 + n) % self.size] + str(self.size - 3)
+			parts.append("info move {} visits {} utility 0.0 winrate {:.6f} scoreMean 0.5 scoreStdev 10.0 scoreLead 0.5 "
+				"scoreSelfplay 0.5 prior {:.6f} lcb {:.6f} utilityLcb 0.0 order {} pv {} {}".format(
+					move, v, 0.5 - n * 0.01, 1 / (n + 2), 0.49 - n * 0.01, n, move, letters[3] + "4"))
+			if "pvVisits" in flags:
+				parts.append("pvVisits {} {}".format(v, v // 2))
+
+		s = " ".join(parts)
+
+		if "ownership" in flags:
+			s += " ownership " + " ".join(["0.100000"] * (self.size * self.size))
+		if "ownershipStdev" in flags:
+			s += " ownershipStdev " + " ".join(["0.500000"] * (self.size * self.size))
+
+		return s
+
+# -------------------------------------------------------------------------------------------------
+
+def main():
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--latency", type = float, default = 0, help = "seconds to wait before each reply")
+	parser.add_argument("--interval", type = float, help = "seconds between info lines, overriding kata-analyze's own")
+	parser.add_argument("--visits-per-line", type = int, default = 100, help = "visits added per info line")
+	parser.add_argument("--candidates", type = int, default = 5, help = "move infos per info line")
+	parser.add_argument("--replay", help = "file of recorded KataGo output whose info lines are sent in turn")
+	opts = parser.parse_args()
+
+	StubEngine(opts).run()
+
+
+if __name__ == "__main__":
+	main()